@@ -1,90 +1,88 @@
 import os
 import json
+import base64
+import time
+import functools
+from urllib.parse import urlparse, parse_qs
 import pandas as pd
 import numpy as np
 import dash
+import flask
 import dash_auth
 import dash_table as dt
 import dash_core_components as dcc
 import dash_html_components as html
 from react_scatter_board import DashScatterBoard
 from scipy.stats import zscore
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
+from cohort import Cohort, CohortCache, cohort_directory, list_cohorts
+from columnar import encode_points
+from metrics import Registry, BYTES_BUCKETS
+from payload import Payload, respond
+from tables import query_table
 
 from dotenv import load_dotenv
 load_dotenv()
 
-def yaml_loads(s):
-    import io, yaml
-    fr = io.StringIO(s)
-    return yaml.load(fr)
+DATA = os.environ.get('DATA', os.path.join(os.path.dirname(__file__), 'data'))
 
-def yaml_dumps(obj):
-    import io, yaml
-    fw = io.StringIO()
-    yaml.dump(obj, fw)
-    return fw.getvalue()
+# Served at /metrics in the Prometheus text format
+registry = Registry()
+data_load_seconds = registry.gauge('cohortsenrichr_data_load_seconds', 'Time spent loading each DATA table of a cohort')
+index_seconds = registry.gauge('cohortsenrichr_cohort_index_seconds', 'Time spent building the indexes of a cohort')
+cohort_loaded = registry.gauge('cohortsenrichr_cohort_loaded_timestamp_seconds', 'When a cohort was last (re)loaded')
+cohort_cache_bytes = registry.gauge('cohortsenrichr_cohort_cache_bytes', 'Approximate memory held by cached cohorts')
+cohorts_cached = registry.gauge('cohortsenrichr_cohorts_cached', 'Number of cached cohorts')
+callback_seconds = registry.histogram('cohortsenrichr_callback_seconds', 'Wall time of Dash callback functions')
+serialization_seconds = registry.histogram('cohortsenrichr_callback_serialization_seconds', 'Time of callback requests spent outside the callback, mostly JSON (de)serialization')
+response_bytes = registry.histogram('cohortsenrichr_callback_response_bytes', 'Size of callback responses', buckets=BYTES_BUCKETS)
 
-DATA = os.environ.get('DATA', os.path.join(os.path.dirname(__file__), 'data'))
-df = pd.read_csv(
-    os.path.join(DATA, 'df.tsv'),
-    sep='\t'
-)
-df.index = df.index.astype(str)
-df.columns = df.columns.astype(str)
-df_umap = pd.read_csv(
-    os.path.join(DATA, 'df_umap.tsv'),
-    sep='\t',
-    index_col='Barcode',
-)
-df_umap.index = df_umap.index.astype(str)
-df_umap.columns = df_umap.columns.astype(str)
-df_enrich = pd.read_csv(
-    os.path.join(DATA, 'df_enrich.tsv'),
-    sep='\t'
-)
-df_enrich.index = df_enrich.index.astype(str)
-df_enrich.columns = df_enrich.columns.astype(str)
-df_metadata = pd.read_csv(
-    os.path.join(DATA, 'metadata.csv'),
-    sep=',',
-    index_col='Barcode',
-)
-df_metadata.index = df_metadata.index.astype(str)
-df_metadata.columns = df_metadata.columns.astype(str)
-df_cluster_aucs = pd.read_csv(
-    os.path.join(DATA, 'cluster_aucs.csv'),
-    sep=',',
-    index_col=0,
-)
-df_cluster_aucs.index = df_cluster_aucs.index.astype(str)
-df_cluster_aucs.columns = df_cluster_aucs.columns.astype(str)
-# df_cluster_aucs.loc[:,:] = zscore(df_cluster_aucs)
-
-meta_cols = [
-    'Barcode',
-    'Cluster',
-    *df_metadata.columns
-]
-
-def figure(Barcode=None):
-    data = [
-        dict(
-            Barcode=barcode,
-            x=record['UMAP-1'],
-            y=record['UMAP-2'],
-            label=yaml_dumps(
-                dict(
-                    Barcode=str(barcode),
-                    Cluster=int(record['Cluster']),
-                )
-            ).replace('\n', '<br>'),
-            **record.to_dict(),
-        )
-        for barcode, record in pd.merge(left=df_umap, left_index=True, right=df_metadata, right_index=True).iterrows()
-    ]
-    return data
+# DATA is a cohort directory or a directory of them, cohorts are loaded on first use and
+#  the least recently used are evicted beyond COHORT_CACHE_MB
+max_points = json.loads(os.environ.get('MAX_POINTS', '100000'))
+metadata_cache_size = json.loads(os.environ.get('METADATA_CACHE_SIZE', '4096'))
+default_cohort = os.environ.get('COHORT', '')
+
+def load_cohort(name, previous=None):
+    cohort = Cohort(
+        name,
+        cohort_directory(DATA, name)[1],
+        max_points=max_points,
+        metadata_cache_size=metadata_cache_size,
+        previous=previous,
+    )
+    for table, seconds in cohort.load_seconds.items():
+        data_load_seconds.set(seconds, cohort=name, table=table)
+    index_seconds.set(cohort.index_seconds, cohort=name)
+    cohort_loaded.set(time.time(), cohort=name)
+    if previous is not None:
+        print('reloaded cohort {}: {} changed, rebuilt {}'.format(name or '(default)', ', '.join(cohort.load_seconds), ', '.join(cohort.rebuilt)))
+    return cohort
+
+cohorts = CohortCache(load_cohort, json.loads(os.environ.get('COHORT_CACHE_MB', '4096')) * 2 ** 20)
+# cached cohorts are checked for changed files every RELOAD_INTERVAL seconds (0 to disable)
+#  and rebuilt in the background as needed, without interrupting requests
+reload_interval = json.loads(os.environ.get('RELOAD_INTERVAL', '5'))
+if reload_interval:
+    cohorts.watch(reload_interval)
+
+def get_cohort(name):
+    ''' The cohort `name`, loading it if needed. Raises KeyError for unknown cohorts.
+    '''
+    cohort = cohorts.get(cohort_directory(DATA, name)[0])
+    cohort_cache_bytes.set(cohorts.nbytes())
+    cohorts_cached.set(len(cohorts.cohorts))
+    return cohort
+
+def event_point(cohort, evt):
+    ''' Barcode and Cluster of the point of a board event, looked up by its index.
+    A page showing an earlier build of the cohort is answered from the event's own fields.
+    '''
+    point = cohort.point(int(evt['index']), evt.get('Barcode')) if 'index' in evt else None
+    if point is None:
+        point = { 'Barcode': str(evt['Barcode']), 'Cluster': int(evt['Cluster']) }
+    return point
 
 
 app = dash.Dash(
@@ -92,13 +90,69 @@ app = dash.Dash(
     meta_tags=[
         {"name": "viewport", "content": "width=device-width"}
     ],
-    routes_pathname_prefix=os.environ.get('PREFIX', '')
+    routes_pathname_prefix=os.environ.get('PREFIX', ''),
+    # the callbacks' components are missing from the cohort list layout
+    suppress_callback_exceptions=True,
 )
+server = app.server
+# dash_auth>=2 checks credentials in a `before_request` hook registered here, ahead of the
+#  hooks and routes below that bypass Dash's views (1.x only wrapped the views that exist now)
 auth = dash_auth.BasicAuth(
     app,
     json.loads(os.environ.get('CREDENTIALS', '{"admin":"admin"}'))
 )
 
+# Requests slower than PROFILE_SLOW_REQUESTS seconds are saved as pyinstrument reports in PROFILE_DIR
+profile_slow_requests = json.loads(os.environ.get('PROFILE_SLOW_REQUESTS', 'null'))
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+
+def instrument(func):
+    ''' Time a callback, `record_request` attributes the rest of its request to Dash
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not flask.has_request_context():
+            return func(*args, **kwargs)
+        flask.g.callback = func.__name__
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flask.g.callback_seconds = time.perf_counter() - start
+    return wrapper
+
+@server.before_request
+def start_request():
+    flask.g.request_started = time.perf_counter()
+    if profile_slow_requests is not None:
+        from pyinstrument import Profiler
+        flask.g.profiler = Profiler(interval=0.001)
+        flask.g.profiler.start()
+
+@server.after_request
+def record_request(response):
+    if 'request_started' not in flask.g:
+        return response
+    elapsed = time.perf_counter() - flask.g.request_started
+    callback = flask.g.get('callback')
+    if callback is not None:
+        callback_seconds.observe(flask.g.callback_seconds, callback=callback)
+        serialization_seconds.observe(max(elapsed - flask.g.callback_seconds, 0.), callback=callback)
+        response_bytes.observe(response.calculate_content_length() or 0, callback=callback)
+    profiler = flask.g.get('profiler')
+    if profiler is not None:
+        profiler.stop()
+        if elapsed >= profile_slow_requests:
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, '{}-{}-{:.0f}ms.html'.format(
+                time.strftime('%Y%m%d-%H%M%S'),
+                callback or flask.request.endpoint,
+                elapsed * 1000,
+            ))
+            with open(path, 'w') as fw:
+                fw.write(profiler.output_html())
+    return response
+
 app.index_string = '''
 <!DOCTYPE html>
 <html>
@@ -132,296 +186,654 @@ app.index_string = '''
 </html>
 '''
 
-app.layout = html.Div(className='row', children=[
-    html.Div(
-        className='col-sm-8',
-        children=[
-            DashScatterBoard(
-                id='umap',
-                data=figure(),
-                shapeKey='Cluster',
-                colorKey='Cluster',
-                labelKeys=['Barcode', 'Cluster'],
-                searchKeys=[col for col in df_metadata.columns if col not in ['orig_id']],
-                width=800,
-                height=500,
-                is3d=False,
-            ),
-        ],
-    ),
-    html.Div(
-        className='col-sm-4',
-        children=[
-            dt.DataTable(
-                id='metadata-table',
-                columns=[
-                    { 'name': 'attribute', 'id': 'attribute' },
-                    { 'name': 'value', 'id': 'value' },
-                ],
-                sort_action='native',
-                sort_mode='multi',
-                filter_action='native',
-                page_action='native',
-                style_header={
-                    'backgroundColor': 'rgb(200, 200, 200)',
-                    'fontWeight': 'bold'
-                },
-                style_data={
-                    'whiteSpace': 'normal',
-                    'height': 'auto',
-                },
-                style_table={
-                    'overflow': 'auto',
-                    'height': 450,
-                    'paddingRight': 15,
-                    'paddingLeft': 15,
-                },
-                css=[
-                    {
-                        'selector': '.dash-cell div.dash-cell-value',
-                        'rule': 'display: inline; white-space: inherit; overflow: inherit; text-overflow: inherit;',
+def request_cohort():
+    ''' Cohort named by the request or else by the page that issued it, as `?cohort=name`
+    or as the path below PREFIX (`<PREFIX>name/`), defaulting to COHORT
+    '''
+    if 'cohort' in flask.request.args:
+        return flask.request.args['cohort']
+    if flask.request.referrer:
+        url = urlparse(flask.request.referrer)
+        query = parse_qs(url.query)
+        if 'cohort' in query:
+            return query['cohort'][0]
+        prefix = app.config.requests_pathname_prefix
+        if url.path.startswith(prefix) and url.path[len(prefix):].strip('/'):
+            return url.path[len(prefix):].strip('/')
+    return default_cohort
+
+def cohort_list_layout(name):
+    prefix = app.config.requests_pathname_prefix
+    return html.Div(className='row', children=[
+        html.Div(
+            className='col-sm-12',
+            children=[
+                html.P('No cohort named {}'.format(name)) if name else None,
+                html.H2('Cohorts'),
+                html.Ul([
+                    html.Li(html.A(cohort or 'default', href=prefix + (cohort + '/' if cohort else '')))
+                    for cohort in list_cohorts(DATA)
+                ]),
+            ],
+        ),
+    ])
+
+def serve_layout():
+    ''' Layout of the page's cohort, the list of cohorts if there is no such cohort
+    '''
+    name = request_cohort()
+    try:
+        return cohort_layout(get_cohort(name))
+    except KeyError:
+        return cohort_list_layout(name)
+
+def cohort_layout(cohort):
+    return html.Div(className='row', children=[
+        html.Div(
+            className='col-sm-8',
+            children=[
+                DashScatterBoard(
+                    id='umap',
+                    # filled in the browser from `umap-points` and `search-matches` by `decode_points`
+                    data=[],
+                    shapeKey='Cluster',
+                    colorKey='Cluster',
+                    labelKeys=['Barcode', 'Cluster'],
+                    # metadata search is served by the `metadata-search` callback instead
+                    searchKeys=[],
+                    width=800,
+                    height=500,
+                    is3d=False,
+                ),
+                # the point cloud above, sent once with the layout in the columnar format of columnar.py
+                dcc.Store(id='umap-points', data=cohort.figure()),
+                # per-session selection state, kept in the browser so any worker can serve any event
+                dcc.Store(id='session-state', storage_type='session'),
+                # the cohort of this page, every callback looks it up in the cohort cache
+                dcc.Store(id='cohort', data=cohort.name),
+                # what the tables show, they page, sort and filter on the server
+                dcc.Store(id='selected-cluster'),
+                dcc.Store(id='hovered-point'),
+                dcc.Input(
+                    id='metadata-search',
+                    type='text',
+                    debounce=True,
+                    placeholder='Search metadata, e.g. value, column:value or "some column:1..10"',
+                    className='form-control',
+                ),
+                html.Small(id='search-results'),
+                # which of the board's points match the search, see `Cohort.overview_mask`
+                dcc.Store(id='search-matches'),
+            ],
+        ),
+        html.Div(
+            className='col-sm-4',
+            children=[
+                dt.DataTable(
+                    id='metadata-table',
+                    columns=[
+                        { 'name': 'attribute', 'id': 'attribute' },
+                        { 'name': 'value', 'id': 'value' },
+                    ],
+                    sort_action='custom',
+                    sort_mode='multi',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
+                    page_action='custom',
+                    page_current=0,
+                    page_size=25,
+                    style_header={
+                        'backgroundColor': 'rgb(200, 200, 200)',
+                        'fontWeight': 'bold'
                     },
-                ],
-                style_data_conditional=[
-                    {
-                        'if': {'row_index': 'odd'},
-                        'backgroundColor': 'rgb(230, 230, 230)'
-                    }
-                ],
-            )
-        ]
-    ),
-    html.Div(
-        className='col-sm-12',
-        children=[
-            html.H2(id='cluster-header'),
-        ],
-    ),
-    html.Div(
-        className='col-sm-6',
-        children=[
-            html.H3('Genetic Enrichment'),
-            html.P('We perform cluster vs rest differential expression for each cluster, submit the most significant genesets to Enrichr, and highlight the top enriched terms here. Full Enrichr results link below.'),
-            html.Label(id='enrichr-link'),
-        ],
-    ),
-    html.Div(
-        className='col-sm-6',
-        children=[
-            html.H3('Clinical Predictors'),
-            html.P('We fit a Logistic Regression using only the attribute in question in an attempt to classify membership in a specific cluster. The AUC of the resulting classifier is recorded, and the relative AUCs reported as Z-Scores.'),
-        ],
-    ),
-    html.Div(
-        className='col-sm-6',
-        children=[
-            dt.DataTable(
-                id='data-table',
-                columns=[
-                    {'name': 'rank', 'id': 'rank'},
-                    {'name': 'direction', 'id': 'direction'},
-                    {'name': 'term', 'id': 'term'},
-                    {'name': 'category', 'id': 'category'},
-                    {'name': 'pvalue', 'id': 'pvalue', 'type': 'numeric', 'format': { 'specifier': '.3' } },
-                    {'name': 'library', 'id': 'library'},
-                ],
-                sort_action='native',
-                sort_mode='multi',
-                filter_action='native',
-                filter_query='{pvalue} < 0.05 && {direction} = up',
-                page_action='native',
-                sort_by=[{ 'column_id': 'pvalue', 'direction': 'asc' }],
-                style_as_list_view=True,
-                style_header={
-                    'backgroundColor': 'rgb(200, 200, 200)',
-                    'fontWeight': 'bold'
-                },
-                style_table={
-                    'overflow': 'auto',
-                    'width': '100%',
-                    'minWidth': '100%',
-                    'paddingRight': 15,
-                    'paddingLeft': 15,
-                },
-                style_data={
-                    'whiteSpace': 'normal',
-                    'height': 'auto',
-                },
-                css=[
-                    {
-                        'selector': '.dash-cell div.dash-cell-value',
-                        'rule': 'display: inline; white-space: inherit; overflow: inherit; text-overflow: inherit;',
+                    style_data={
+                        'whiteSpace': 'normal',
+                        'height': 'auto',
+                    },
+                    style_table={
+                        'overflow': 'auto',
+                        'height': 450,
+                        'paddingRight': 15,
+                        'paddingLeft': 15,
+                    },
+                    css=[
+                        {
+                            'selector': '.dash-cell div.dash-cell-value',
+                            'rule': 'display: inline; white-space: inherit; overflow: inherit; text-overflow: inherit;',
+                        },
+                    ],
+                    style_data_conditional=[
+                        {
+                            'if': {'row_index': 'odd'},
+                            'backgroundColor': 'rgb(230, 230, 230)'
+                        }
+                    ],
+                )
+            ]
+        ),
+        html.Div(
+            className='col-sm-12',
+            children=[
+                html.H2(id='cluster-header'),
+            ],
+        ),
+        html.Div(
+            className='col-sm-6',
+            children=[
+                html.H3('Genetic Enrichment'),
+                html.P('We perform cluster vs rest differential expression for each cluster, submit the most significant genesets to Enrichr, and highlight the top enriched terms here. Full Enrichr results link below.'),
+                html.Label(id='enrichr-link'),
+            ],
+        ),
+        html.Div(
+            className='col-sm-6',
+            children=[
+                html.H3('Clinical Predictors'),
+                html.P('We fit a Logistic Regression using only the attribute in question in an attempt to classify membership in a specific cluster. The AUC of the resulting classifier is recorded, and the relative AUCs reported as Z-Scores.'),
+            ],
+        ),
+        html.Div(
+            className='col-sm-6',
+            children=[
+                dt.DataTable(
+                    id='data-table',
+                    columns=[
+                        {'name': 'rank', 'id': 'rank'},
+                        {'name': 'direction', 'id': 'direction'},
+                        {'name': 'term', 'id': 'term'},
+                        {'name': 'category', 'id': 'category'},
+                        {'name': 'pvalue', 'id': 'pvalue', 'type': 'numeric', 'format': { 'specifier': '.3' } },
+                        {'name': 'library', 'id': 'library'},
+                    ],
+                    sort_action='custom',
+                    sort_mode='multi',
+                    filter_action='custom',
+                    filter_query='{pvalue} < 0.05 && {direction} = up',
+                    page_action='custom',
+                    page_current=0,
+                    page_size=25,
+                    sort_by=[{ 'column_id': 'pvalue', 'direction': 'asc' }],
+                    style_as_list_view=True,
+                    style_header={
+                        'backgroundColor': 'rgb(200, 200, 200)',
+                        'fontWeight': 'bold'
                     },
-                ],
-                style_data_conditional=[
-                    {
-                        'if': {'row_index': 'odd'},
-                        'backgroundColor': 'rgb(230, 230, 230)'
-                    }
-                ],
-                style_cell_conditional=[
-                    {
-                        'if': { 'column_id': 'term' },
-                        'textAlign': 'left',
-                        'maxWidth': '20vw',
+                    style_table={
+                        'overflow': 'auto',
+                        'width': '100%',
+                        'minWidth': '100%',
+                        'paddingRight': 15,
+                        'paddingLeft': 15,
                     },
-                    {
-                        'if': { 'column_id': 'category' },
-                        'textAlign': 'left',
+                    style_data={
+                        'whiteSpace': 'normal',
+                        'height': 'auto',
                     },
-                    {
-                        'if': { 'column_id': 'direction' },
-                        'textAlign': 'center',
+                    css=[
+                        {
+                            'selector': '.dash-cell div.dash-cell-value',
+                            'rule': 'display: inline; white-space: inherit; overflow: inherit; text-overflow: inherit;',
+                        },
+                    ],
+                    style_data_conditional=[
+                        {
+                            'if': {'row_index': 'odd'},
+                            'backgroundColor': 'rgb(230, 230, 230)'
+                        }
+                    ],
+                    style_cell_conditional=[
+                        {
+                            'if': { 'column_id': 'term' },
+                            'textAlign': 'left',
+                            'maxWidth': '20vw',
+                        },
+                        {
+                            'if': { 'column_id': 'category' },
+                            'textAlign': 'left',
+                        },
+                        {
+                            'if': { 'column_id': 'direction' },
+                            'textAlign': 'center',
+                        },
+                        {
+                            'if': { 'column_id': 'library' },
+                            'textAlign': 'left',
+                            'maxWidth': '10vw',
+                        },
+                    ],
+                ),
+            ],
+        ),
+        html.Div(
+            className='col-sm-6',
+            children=[
+                dt.DataTable(
+                    id='summary-table',
+                    columns=[
+                        { 'name': 'attribute', 'id': 'attribute' },
+                    ] + [
+                        {'name': col, 'id': col, 'type': 'numeric', 'format': {'specifier': '.3'} }
+                        for col in cohort.df_cluster_aucs.columns
+                    ],
+                    sort_action='custom',
+                    sort_mode='multi',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
+                    page_action='custom',
+                    page_current=0,
+                    page_size=25,
+                    style_as_list_view=True,
+                    style_header={
+                        'backgroundColor': 'rgb(200, 200, 200)',
+                        'fontWeight': 'bold'
                     },
-                    {
-                        'if': { 'column_id': 'library' },
-                        'textAlign': 'left',
-                        'maxWidth': '10vw',
+                    style_table={
+                        'overflow': 'auto',
+                        'width': '100%',
+                        'minWidth': '100%',
+                        'paddingRight': 15,
+                        'paddingLeft': 15,
                     },
-                ],
-            ),
-        ],
-    ),
-    html.Div(
-        className='col-sm-6',
-        children=[
-            dt.DataTable(
-                id='summary-table',
-                columns=[
-                    { 'name': 'attribute', 'id': 'attribute' },
-                ] + [
-                    {'name': col, 'id': col, 'type': 'numeric', 'format': {'specifier': '.3'} }
-                    for col in df_cluster_aucs.columns
-                ],
-                sort_action='native',
-                sort_mode='multi',
-                filter_action='native',
-                page_action='native',
-                style_as_list_view=True,
-                style_header={
-                    'backgroundColor': 'rgb(200, 200, 200)',
-                    'fontWeight': 'bold'
-                },
-                style_table={
-                    'overflow': 'auto',
-                    'width': '100%',
-                    'minWidth': '100%',
-                    'paddingRight': 15,
-                    'paddingLeft': 15,
-                },
-                style_data={
-                    'whiteSpace': 'normal',
-                    'height': 'auto',
-                },
-                css=[
-                    {
-                        'selector': '.dash-cell div.dash-cell-value',
-                        'rule': 'display: inline; white-space: inherit; overflow: inherit; text-overflow: inherit;',
+                    style_data={
+                        'whiteSpace': 'normal',
+                        'height': 'auto',
                     },
-                ],
-                style_data_conditional=[
-                    {
-                        'if': {'row_index': 'odd'},
-                        'backgroundColor': 'rgb(230, 230, 230)'
-                    }
-                ],
-            ),
-        ],
-    ),
-])
-
-lock = False
-prevClickData = None
-clusterData = None
-patientData = {}
+                    css=[
+                        {
+                            'selector': '.dash-cell div.dash-cell-value',
+                            'rule': 'display: inline; white-space: inherit; overflow: inherit; text-overflow: inherit;',
+                        },
+                    ],
+                    style_data_conditional=[
+                        {
+                            'if': {'row_index': 'odd'},
+                            'backgroundColor': 'rgb(230, 230, 230)'
+                        }
+                    ],
+                ),
+            ],
+        ),
+    ])
+
+app.layout = serve_layout
+
+def cached_payload(cohort, key, build):
+    ''' Payload of `key` for this build of `cohort`, serialized on first use
+    '''
+    payload = cohort.responses.get(key)
+    if payload is None:
+        payload = cohort.responses.setdefault(key, Payload.json(build()))
+    return payload
+
+@server.before_request
+def serve_cached_layout():
+    ''' `_dash-layout` of a cohort page, serialized and compressed once per cohort build
+    rather than by Dash on every page load
+    '''
+    if flask.request.path != app.config.routes_pathname_prefix + '_dash-layout':
+        return None
+    try:
+        cohort = get_cohort(request_cohort())
+    except KeyError:
+        return None
+    return respond(cached_payload(cohort, 'layout', lambda: cohort_layout(cohort)))
+
+# Points of the board from the columnar format of columnar.py, in the browser. While a search
+#  is active only its matches are drawn, given as a bitmask over the points (base64, LSB first).
+decode_points = '''
+function(points, matches) {
+    if (!points) {
+        return window.dash_clientside.no_update;
+    }
+    function bytes(data) {
+        var binary = atob(data);
+        var array = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            array[i] = binary.charCodeAt(i);
+        }
+        return array;
+    }
+    // decoded once per point cloud, searches only filter it
+    var board = window.cohortsEnrichrBoard;
+    if (!board || board.points !== points) {
+        var arrays = {
+            float32: Float32Array, uint8: Uint8Array, uint16: Uint16Array, uint32: Uint32Array,
+        };
+        var decode = function(column) {
+            if (column.data === undefined) {
+                return column.values;
+            }
+            var array = new arrays[column.dtype](bytes(column.data).buffer);
+            if (column.values !== undefined) {
+                return Array.from(array, function(code) { return column.values[code]; });
+            }
+            return Array.from(array, function(value) { return isNaN(value) ? null : value; });
+        };
+        var names = Object.keys(points.columns);
+        var columns = names.map(function(name) { return decode(points.columns[name]); });
+        var data = new Array(points.length);
+        for (var i = 0; i < points.length; i++) {
+            var point = {};
+            for (var j = 0; j < names.length; j++) {
+                point[names[j]] = columns[j][i];
+            }
+            point.label = 'Barcode: ' + point.Barcode + '<br>Cluster: ' + point.Cluster + '<br>';
+            data[i] = point;
+        }
+        board = window.cohortsEnrichrBoard = { points: points, data: data };
+    }
+    if (!matches) {
+        return board.data;
+    }
+    var mask = bytes(matches);
+    return board.data.filter(function(point, i) { return mask[i >> 3] & (1 << (i & 7)); });
+}
+'''
+
+app.clientside_callback(
+    decode_points,
+    Output('umap', 'data'),
+    [
+        Input('umap-points', 'data'),
+        Input('search-matches', 'data'),
+    ],
+)
+
+def page_cohort(name):
+    ''' The cohort of the page a callback is for, skipping the update if it is gone
+    '''
+    try:
+        return get_cohort(name)
+    except KeyError:
+        raise PreventUpdate
 
 @app.callback(
     [
         Output('cluster-header', 'children'),
         Output('enrichr-link', 'children'),
-        Output('data-table', 'data'),
-        Output('metadata-table', 'data'),
-        Output('summary-table', 'data'),
-        Output('umap', 'data'),
+        Output('session-state', 'data'),
+        Output('selected-cluster', 'data'),
+        Output('hovered-point', 'data'),
     ],
     [
         Input('umap', 'clickData'),
         Input('umap', 'hoverData'),
+    ],
+    [
+        State('session-state', 'data'),
+        State('selected-cluster', 'data'),
+        State('cohort', 'data'),
     ]
 )
-def update_click(clickData, hoverData):
-    global lock, prevClickData, clusterData, patientData
+@instrument
+def update_click(clickData, hoverData, state, selected_cluster, cohort):
     # Initial state
     if not clickData and not hoverData:
         return [
             'Click to cluster to select',
             '',
-            [],
-            [],
-            [],
-            figure(),
+            dash.no_update,
+            None,
+            None,
         ]
+    cohort = page_cohort(cohort)
+    # the session state of another cohort's page does not carry over
+    if (state or {}).get('cohort') != cohort.name:
+        state = None
+    state = {
+        'lock': False,
+        'prevClickData': None,
+        'Barcode': None,
+        'cluster': None,
+        'cohort': cohort.name,
+        **(state or {}),
+    }
+    # a reloaded page keeps its session state but not its last click
+    if clickData is None and state['prevClickData'] is not None:
+        state['lock'] = False
+        state['prevClickData'] = None
     # Get relevant evt
-    if prevClickData != clickData: # Click
-        lock = not lock
-        prevClickData = clickData
+    if state['prevClickData'] != clickData: # Click
+        state['lock'] = not state['lock']
+        state['prevClickData'] = clickData
         evt = clickData
     else:
         evt = hoverData
+    if evt is None:
+        raise PreventUpdate
+    lock = state['lock']
     # Get point
-    pointData = yaml_loads(evt['label'].replace('<br>', '\n'))
+    pointData = event_point(cohort, evt)
     # Get patient data
     if not lock:
-        Barcode = pointData['Barcode']
-        patientData['Barcode'] = Barcode
-    else:
-        Barcode = patientData.get('Barcode')
+        state['Barcode'] = pointData['Barcode']
     # Get cluster
     cluster = pointData['Cluster']
-    m = dict(
-        **pointData,
-        **df_metadata.loc[[pointData['Barcode']]].to_dict('records')[0],
-    )
-    metadata = [
-        {
-            'attribute': k,
-            'value': m[k],
-        }
-        for k in meta_cols
-    ]
-    if not lock and (clusterData is None or clusterData['cluster'] != cluster):
-        summary = df_cluster_aucs.reset_index().rename({ 'index': 'attribute' }, axis=1).sort_values(str(cluster), ascending=False).to_dict('records')
-        matches = df_enrich[df_enrich['cluster'] == cluster]
-        clusterData = {
-            'cluster': cluster,
-            'summary': summary,
-            'matches': matches,
-        }
+    if lock and state['cluster'] is not None:
+        cluster = state['cluster']
+    state['cluster'] = cluster
+    link, data = cohort.enrichment_index.get(cluster, (None, None))
+    header = 'Cluster {} ({} samples)'.format(cluster, cohort.cluster_sizes.get(cluster, 0))
+    if data is None:
+        enrichr_link = 'No data for this cluster'
+    elif link:
+        enrichr_link = ['Enrichr Link for Cluster ', html.A(link, href=link)]
     else:
-        cluster = clusterData['cluster']
-        summary = clusterData['summary']
-        matches = clusterData['matches']
-    if matches.size == 0:
-        return [
-            'Cluster {} ({} samples)'.format(cluster, df_umap[df_umap['Cluster'] == cluster].shape[0]),
-            'No data for this cluster',
-            [],
-            metadata,
-            summary,
-            figure(Barcode),
-        ]
-    # Update
-    link = matches.iloc[0]['link']
-    data = matches.to_dict('records')
+        enrichr_link = 'Enrichment computed offline, no Enrichr link'
     return [
-        'Cluster {} ({} samples)'.format(cluster, df_umap[df_umap['Cluster'] == cluster].shape[0]),
-        ['Enrichr Link for Cluster ', html.A(link, href=link)],
-        data,
-        metadata,
-        summary,
-        figure(Barcode),
+        header,
+        enrichr_link,
+        state,
+        # the cluster tables only refresh when the cluster changes
+        cluster if cluster != selected_cluster else dash.no_update,
+        pointData,
     ]
 
+def table_page(table, page_current):
+    ''' The page a table callback serves: the requested one when paging triggered it, otherwise
+    the first, as a new cluster, point, sort or filter may have fewer pages
+    '''
+    if table + '.page_current' in (t['prop_id'] for t in dash.callback_context.triggered):
+        return page_current or 0
+    return 0
+
+@app.callback(
+    [
+        Output('data-table', 'data'),
+        Output('data-table', 'page_count'),
+        Output('data-table', 'page_current'),
+    ],
+    [
+        Input('selected-cluster', 'data'),
+        Input('data-table', 'page_current'),
+        Input('data-table', 'page_size'),
+        Input('data-table', 'sort_by'),
+        Input('data-table', 'filter_query'),
+    ],
+    [
+        State('cohort', 'data'),
+    ]
+)
+@instrument
+def update_enrichment_table(cluster, page_current, page_size, sort_by, filter_query, cohort):
+    _, matches = page_cohort(cohort).enrichment_index.get(cluster, (None, None))
+    if matches is None:
+        return [], 1, 0
+    page_current = table_page('data-table', page_current)
+    return [*query_table(
+        matches, filter_query, sort_by, page_current, page_size,
+        presorted=[{ 'column_id': 'pvalue', 'direction': 'asc' }],
+    ), page_current]
+
+@app.callback(
+    [
+        Output('summary-table', 'data'),
+        Output('summary-table', 'page_count'),
+        Output('summary-table', 'page_current'),
+    ],
+    [
+        Input('selected-cluster', 'data'),
+        Input('summary-table', 'page_current'),
+        Input('summary-table', 'page_size'),
+        Input('summary-table', 'sort_by'),
+        Input('summary-table', 'filter_query'),
+    ],
+    [
+        State('cohort', 'data'),
+    ]
+)
+@instrument
+def update_summary_table(cluster, page_current, page_size, sort_by, filter_query, cohort):
+    summary = page_cohort(cohort).summary_index.get(str(cluster))
+    if summary is None:
+        return [], 1, 0
+    page_current = table_page('summary-table', page_current)
+    return [*query_table(
+        summary, filter_query, sort_by, page_current, page_size,
+        presorted=[{ 'column_id': str(cluster), 'direction': 'desc' }],
+    ), page_current]
+
+@app.callback(
+    [
+        Output('metadata-table', 'data'),
+        Output('metadata-table', 'page_count'),
+        Output('metadata-table', 'page_current'),
+    ],
+    [
+        Input('hovered-point', 'data'),
+        Input('metadata-table', 'page_current'),
+        Input('metadata-table', 'page_size'),
+        Input('metadata-table', 'sort_by'),
+        Input('metadata-table', 'filter_query'),
+    ],
+    [
+        State('cohort', 'data'),
+    ]
+)
+@instrument
+def update_metadata_table(pointData, page_current, page_size, sort_by, filter_query, cohort):
+    if not pointData:
+        return [], 1, 0
+    cohort = page_cohort(cohort)
+    position = cohort.metadata_store.positions.get(pointData['Barcode'])
+    if position is None:
+        return [], 1, 0
+    page_current = table_page('metadata-table', page_current)
+    if not sort_by and not filter_query:
+        return [*cohort.metadata_page(position, pointData['Barcode'], pointData['Cluster'], page_current, page_size or 25), page_current]
+    metadata = pd.DataFrame(cohort.metadata_store.records(position, pointData['Barcode'], pointData['Cluster']))
+    return [*query_table(metadata, filter_query, sort_by, page_current, page_size), page_current]
+
+def search_barcodes(cohort, query):
+    rows = cohort.metadata_index.search(query)
+    return rows.shape[0], cohort.metadata_index.barcodes[rows]
+
+def search_mask(cohort, query):
+    ''' Number of cells matching `query` and the base64 bitmask of the board's points among them
+    '''
+    rows = cohort.metadata_index.search(query)
+    mask = cohort.overview_mask(rows)
+    return rows.shape[0], int(mask.sum()), base64.b64encode(np.packbits(mask, bitorder='little').tobytes()).decode('ascii')
+
+@app.callback(
+    [
+        Output('search-results', 'children'),
+        Output('search-matches', 'data'),
+    ],
+    [
+        Input('metadata-search', 'value'),
+    ],
+    [
+        State('cohort', 'data'),
+    ]
+)
+@instrument
+def update_search(query, cohort):
+    if not query:
+        return '', None
+    try:
+        count, shown, mask = search_mask(page_cohort(cohort), query)
+    except ValueError:
+        return 'Invalid number in search', None
+    if shown < count:
+        return '{} matching cells, {} of them drawn'.format(count, shown), mask
+    return '{} matching cells'.format(count), mask
+
+def route_cohort():
+    ''' The cohort of a data route request, 404 if there is none
+    '''
+    try:
+        return get_cohort(request_cohort())
+    except KeyError:
+        flask.abort(404)
+
+@server.route(app.config.routes_pathname_prefix + 'search')
+def serve_search():
+    ''' Barcodes matching the metadata search `q` (see `MetadataIndex.search`), at most `limit`
+    '''
+    cohort = route_cohort()
+    args = flask.request.args
+    try:
+        count, barcodes = search_barcodes(cohort, args.get('q', ''))
+        if 'limit' in args:
+            barcodes = barcodes[:int(args['limit'])]
+    except ValueError:
+        flask.abort(400)
+    return flask.jsonify(count=count, Barcode=barcodes.tolist())
+
+@server.route(app.config.routes_pathname_prefix + 'points')
+def serve_points():
+    ''' Points of the current viewport (x0, x1, y0, y1), at full resolution once zoomed in
+    enough for at most `limit` (<= MAX_POINTS) of them to be visible
+    '''
+    cohort = route_cohort()
+    args = flask.request.args
+    try:
+        limit = min(int(args.get('limit', max_points)), max_points)
+        bounds = tuple(float(args[k]) for k in ('x0', 'x1', 'y0', 'y1')) if 'x0' in args else None
+    except (KeyError, ValueError):
+        flask.abort(400)
+    if bounds is None and limit == max_points:
+        return respond(cached_payload(cohort, 'overview', lambda: cohort.overview))
+    return respond(Payload.json(encode_points(cohort.df_points, cohort.point_index.query(bounds, limit))))
+
+@server.route(app.config.routes_pathname_prefix + 'enrichment')
+def serve_enrichment():
+    ''' Enrichment results of `cluster` by p-value with its Enrichr link
+    '''
+    cohort = route_cohort()
+    try:
+        cluster = int(flask.request.args['cluster'])
+    except (KeyError, ValueError):
+        flask.abort(400)
+    if cluster not in cohort.enrichment_index:
+        flask.abort(404)
+    def build():
+        link, matches = cohort.enrichment_index[cluster]
+        return {'cluster': cluster, 'link': link, 'results': matches.to_dict('records')}
+    return respond(cached_payload(cohort, ('enrichment', cluster), build))
+
+@server.route(app.config.routes_pathname_prefix + 'summary')
+def serve_summary():
+    ''' Attribute AUCs of all clusters sorted by those of `cluster`
+    '''
+    cohort = route_cohort()
+    cluster = flask.request.args.get('cluster', '')
+    if cluster not in cohort.summary_index:
+        flask.abort(404)
+    return respond(cached_payload(cohort, ('summary', cluster), lambda: {
+        'cluster': cluster,
+        'results': cohort.summary_index[cluster].to_dict('records'),
+    }))
+
+@server.route(app.config.routes_pathname_prefix + 'metrics')
+def serve_metrics():
+    ''' Callback latency, serialization time and payload size histograms and data load times
+    '''
+    return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
     app.run_server(
         host=os.environ.get('HOST', '0.0.0.0'),
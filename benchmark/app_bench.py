@@ -0,0 +1,117 @@
+''' Time `app.py` against the DATA directory in the environment.
+
+Run in a fresh interpreter by `benchmark/run.py` so startup includes loading DATA:
+`DATA=out/data python3 benchmark/app_bench.py results.json [events]`. Callbacks are driven
+through the Flask test client, so latencies include Dash's request handling and JSON
+serialization, and payloads are the response bytes a browser would receive.
+'''
+import os
+import sys
+import json
+import time
+import base64
+import numpy as np
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'n': int(samples.shape[0]),
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'max': float(samples.max()),
+    }
+
+def main(path, events=200, seed=42):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    start = time.perf_counter()
+    import app
+    from payload import dumps
+    cohort = app.get_cohort(app.default_cohort)
+    startup = time.perf_counter() - start
+
+    client = app.server.test_client()
+    user, password = next(iter(json.loads(os.environ.get('CREDENTIALS', '{"admin":"admin"}')).items()))
+    headers = {'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(user, password).encode()).decode()}
+    prefix = app.app.config.requests_pathname_prefix
+
+    def callback(output, inputs, state=()):
+        ''' POST one callback request, returns (seconds, response bytes, response)
+        '''
+        key = next(k for k in app.app.callback_map if output in k)
+        spec = app.app.callback_map[key]
+        outputs = [
+            {'id': o.rsplit('.', 1)[0], 'property': o.rsplit('.', 1)[1]}
+            for o in key.strip('.').split('...')
+        ]
+        body = {
+            'output': key,
+            'outputs': outputs if key.startswith('..') else outputs[0],
+            'inputs': [dict(id=i['id'], property=i['property'], value=v) for i, v in zip(spec['inputs'], inputs)],
+            'state': [dict(id=s['id'], property=s['property'], value=v) for s, v in zip(spec['state'], state)],
+            'changedPropIds': [],
+        }
+        start = time.perf_counter()
+        resp = client.post(prefix + '_dash-update-component', json=body, headers=headers)
+        elapsed = time.perf_counter() - start
+        if resp.status_code == 204:
+            return elapsed, 0, {}
+        if resp.status_code != 200:
+            raise Exception('{} failed with status {}: {}'.format(output, resp.status_code, resp.data[:200]))
+        return elapsed, len(resp.data), resp.get_json()['response']
+
+    results = {'startup_s': startup, 'points': cohort.df_points.shape[0], 'overview_points': cohort.overview['length'], 'cohort_bytes': cohort.nbytes}
+
+    # initial figure and the layout that carries it
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        payload = dumps(cohort.figure())
+        samples.append(time.perf_counter() - start)
+    results['figure'] = dict(summarize(samples), bytes=len(payload))
+    for encoding in ['identity', 'gzip']:
+        start = time.perf_counter()
+        resp = client.get(prefix + '_dash-layout', headers=dict(headers, **{'Accept-Encoding': encoding}))
+        results['layout_' + encoding] = {'s': time.perf_counter() - start, 'bytes': len(resp.data)}
+    start = time.perf_counter()
+    resp = client.get(prefix + '_dash-layout', headers=dict(headers, **{'If-None-Match': resp.headers['ETag']}))
+    results['layout_revalidate'] = {'s': time.perf_counter() - start, 'status': resp.status_code}
+
+    # hovers over random points, with a click every tenth event
+    rng = np.random.default_rng(seed)
+    state, selected, clickData = None, None, None
+    timings = {'hover': ([], []), 'click': ([], []), 'tables': ([], [])}
+    for i, position in enumerate(rng.integers(cohort.df_points.shape[0], size=events)):
+        # the fields of a decoded board point that events carry back
+        point = cohort.point(int(position))
+        kind = 'click' if i % 10 == 9 else 'hover'
+        if kind == 'click':
+            clickData = point
+        elapsed, size, response = callback('cluster-header.children', [clickData, point], [state, selected, cohort.name])
+        timings[kind][0].append(elapsed)
+        timings[kind][1].append(size)
+        state = response.get('session-state', {}).get('data', state)
+        selected = response.get('selected-cluster', {}).get('data', selected)
+        hovered = response.get('hovered-point', {}).get('data')
+        # the table callbacks that the store updates trigger in the browser
+        elapsed, size = 0., 0
+        if 'selected-cluster' in response:
+            for table, sort_by, filter_query in [
+                ('data-table', [{'column_id': 'pvalue', 'direction': 'asc'}], '{pvalue} < 0.05 && {direction} = up'),
+                ('summary-table', [], ''),
+            ]:
+                e, s, _ = callback(table + '.data', [selected, 0, 25, sort_by, filter_query], [cohort.name])
+                elapsed, size = elapsed + e, size + s
+        e, s, _ = callback('metadata-table.data', [hovered, 0, 25, [], ''], [cohort.name])
+        timings['tables'][0].append(elapsed + e)
+        timings['tables'][1].append(size + s)
+    for kind, (samples, sizes) in timings.items():
+        if samples:
+            results[kind] = dict(summarize(samples), bytes=summarize(sizes))
+
+    with open(path, 'w') as fw:
+        json.dump(results, fw, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1], *map(int, sys.argv[2:3]))
@@ -0,0 +1,86 @@
+''' Local stand-in for the Enrichr API used by the benchmarks.
+
+Answers `/addList` and `/enrich` under any prefix with deterministic synthetic results,
+optionally after an artificial `latency`, so `init.py` can be timed without network access:
+`python3 benchmark/enrichr_server.py --port 8080` then `ENRICHR_URL=http://127.0.0.1:8080/Enrichr`.
+'''
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import threading
+import numpy as np
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class EnrichrHandler(BaseHTTPRequestHandler):
+    latency = 0.
+    results = 50
+    user_list_ids = itertools.count(1)
+
+    def respond(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        if not urlparse(self.path).path.endswith('/addList'):
+            return self.send_error(404)
+        self.respond({
+            'userListId': next(self.user_list_ids),
+            'shortId': hashlib.md5(body).hexdigest(),
+        })
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.latency)
+        if not url.path.endswith('/enrich'):
+            return self.send_error(404)
+        params = parse_qs(url.query)
+        library = params['backgroundType'][0]
+        seed = int(hashlib.md5('{}:{}'.format(params['userListId'][0], library).encode()).hexdigest()[:8], 16)
+        rng = np.random.default_rng(seed)
+        pvalues = np.sort(rng.uniform(size=self.results) ** 4)
+        self.respond({
+            library: [
+                [rank + 1, '{} term {}'.format(library, term), pvalue, zscore, -np.log(pvalue) * zscore, ['GENE%d' % g for g in genes], min(1., pvalue * self.results / (rank + 1)), 0, 0]
+                for rank, (term, pvalue, zscore, genes) in enumerate(zip(
+                    rng.integers(1000, size=self.results).tolist(),
+                    pvalues.tolist(),
+                    rng.gamma(2, size=self.results).tolist(),
+                    rng.integers(2000, size=(self.results, 5)).tolist(),
+                ))
+            ]
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host='127.0.0.1', port=0, latency=0.):
+    ''' Start the stand-in server on a background thread, `server.url` is its Enrichr link
+    '''
+    handler = type('Handler', (EnrichrHandler,), {'latency': latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.url = 'http://{}:{}/Enrichr'.format(*server.server_address[:2])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to every response')
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency)
+    print('Serving Enrichr stand-in at', server.url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
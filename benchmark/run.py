@@ -0,0 +1,155 @@
+''' Benchmark cohortsEnrichr on a synthetic cohort and record the results.
+
+`python3 benchmark/run.py --cells 100000 --genes 5000 --clusters 20 --metadata-columns 30`
+generates the cohort, runs `init.py` against a local Enrichr stand-in with per-stage
+timings, then times `app.py` startup, the initial figure and hover/click callbacks.
+Each run is stored as `benchmark/results/<time>-<cells>x<genes>x<clusters>x<metadata>.json`;
+`--compare` prints the change against the previous run with the same parameters.
+'''
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import synthetic
+from enrichr_server import serve
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_init(cohort, workdir, latency=0.):
+    ''' Run init.py cold (empty Enrichr and NCBI caches), returns its stage timings and those
+    of an immediate rerun, which only checks its stage cache
+    '''
+    server = serve(latency=latency)
+    output = os.path.join(workdir, 'init')
+    env = dict(
+        os.environ,
+        ENRICHR_URL=server.url,
+        ENRICHR_RATE='1000',
+        ENRICHR_WORKERS='8',
+        ENRICHR_CACHE=os.path.join(workdir, 'enrichr_cache'),
+        NCBI_GENE_INFO=cohort['gene_info'],
+        NCBI_CACHE=os.path.join(workdir, 'ncbi_lookup.pkl'),
+    )
+    env.pop('ENRICHR_GMT', None)
+    runs = []
+    try:
+        for run in ['cold', 'rerun']:
+            timings = os.path.join(workdir, 'init_timings_{}.json'.format(run))
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(root, 'init.py'), cohort['analysis'], output], cwd=root, env=dict(env, INIT_TIMINGS=timings), check=True, stdout=subprocess.DEVNULL)
+            total = time.perf_counter() - start
+            with open(timings, 'r') as fr:
+                runs.append(dict(json.load(fr), total_s=total))
+    finally:
+        server.shutdown()
+    return dict(runs[0], rerun=runs[1])
+
+def run_app(cohort, workdir, events=200):
+    path = os.path.join(workdir, 'app.json')
+    subprocess.run(
+        [sys.executable, os.path.join(root, 'benchmark', 'app_bench.py'), path, str(events)],
+        cwd=root,
+        env=dict(os.environ, DATA=cohort['data']),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    with open(path, 'r') as fr:
+        return json.load(fr)
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+def read_record(path):
+    with open(path, 'r') as fr:
+        return json.load(fr)
+
+def compare(results, previous):
+    ''' Print every metric of `results` next to `previous` with the relative change
+    '''
+    before = dict(flatten(previous['results']))
+    print('{:<40} {:>14} {:>14} {:>8}'.format('metric', previous['commit'] or 'previous', results['commit'] or 'current', 'change'))
+    for key, value in flatten(results['results']):
+        if key in before:
+            change = '{:+.0%}'.format(value / before[key] - 1) if before[key] else ''
+            print('{:<40} {:>14.6g} {:>14.6g} {:>8}'.format(key, before[key], value, change))
+
+if __name__ == '__main__':
+    parser = synthetic.add_arguments(argparse.ArgumentParser(description=__doc__.splitlines()[0]))
+    parser.add_argument('--events', type=int, default=200, help='hover/click events to replay')
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to every stand-in Enrichr response')
+    parser.add_argument('--skip-init', action='store_true')
+    parser.add_argument('--skip-app', action='store_true')
+    parser.add_argument('--workdir', help='keep the generated cohort here instead of a temporary directory')
+    parser.add_argument('--results', default=os.path.join(root, 'benchmark', 'results'))
+    parser.add_argument('--compare', action='store_true')
+    args = parser.parse_args()
+
+    parameters = {
+        'cells': args.cells,
+        'genes': args.genes,
+        'clusters': args.clusters,
+        'metadata_columns': args.metadata_columns,
+        'seed': args.seed,
+        'events': args.events,
+        'latency': args.latency,
+    }
+    workdir = args.workdir or tempfile.mkdtemp(prefix='cohortsEnrichr-benchmark-')
+    try:
+        start = time.perf_counter()
+        cohort = synthetic.write_cohort(
+            workdir,
+            cells=args.cells,
+            genes=args.genes,
+            clusters=args.clusters,
+            metadata_columns=args.metadata_columns,
+            seed=args.seed,
+        )
+        results = {'generate_s': time.perf_counter() - start}
+        if not args.skip_init:
+            results['init'] = run_init(cohort, workdir, latency=args.latency)
+        if not args.skip_app:
+            results['app'] = run_app(cohort, workdir, events=args.events)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {
+        'parameters': parameters,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    name = '{}-{}x{}x{}x{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S'), args.cells, args.genes, args.clusters, args.metadata_columns,
+    )
+    os.makedirs(args.results, exist_ok=True)
+    previous = [
+        path
+        for path in sorted(glob.glob(os.path.join(args.results, '*.json')))
+        if read_record(path)['parameters'] == parameters
+    ]
+    with open(os.path.join(args.results, name), 'w') as fw:
+        json.dump(record, fw, indent=2)
+    if args.compare and previous:
+        compare(record, read_record(previous[-1]))
+    else:
+        print(json.dumps(record, indent=2))
@@ -0,0 +1,142 @@
+''' Synthetic cohort generator for the benchmarks.
+
+`python3 benchmark/synthetic.py out --cells 100000 --genes 5000 --clusters 20 --metadata-columns 30`
+writes a 10x-style analysis directory for `init.py` (`out/analysis`), a matching NCBI
+`gene_info` file (`out/gene_info.tsv`) and a complete DATA directory for `app.py` (`out/data`).
+'''
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+categories = ['Diseases', 'Phenotypes', 'Cell Type', 'Pathways', 'Transcription']
+
+def write_table(df, path, **kwargs):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, **kwargs)
+    return path
+
+def write_cohort(directory, cells=10000, genes=2000, clusters=10, metadata_columns=10, libraries=12, top_n_results=5, seed=42):
+    ''' Write a reproducible synthetic cohort of `cells` x `genes` in `clusters` clusters
+    '''
+    rng = np.random.default_rng(seed)
+    barcodes = np.array(['CELL%08d' % i for i in range(cells)], dtype=object)
+    cluster = rng.integers(clusters, size=cells)
+    centers = rng.normal(scale=10, size=(clusters, 2))
+    umap = centers[cluster] + rng.normal(size=(cells, 2))
+    symbols = np.array(['GENE%d' % i for i in range(genes)], dtype=object)
+    # every third gene is reported under one of its synonyms
+    names = np.where(np.arange(genes) % 3 == 0, np.char.add('ALIAS', np.arange(genes).astype(str)).astype(object), symbols)
+    analysis = os.path.join(directory, 'analysis')
+    data = os.path.join(directory, 'data')
+
+    # init.py inputs
+    write_table(
+        pd.DataFrame({'Barcode': barcodes, 'Cluster': cluster}),
+        os.path.join(analysis, 'clustering', 'graphclust', 'clusters.csv'),
+        index=None,
+    )
+    write_table(
+        pd.DataFrame({'Barcode': barcodes, 'UMAP-1': umap[:, 0], 'UMAP-2': umap[:, 1]}),
+        os.path.join(analysis, 'umap', '2_components', 'projection.csv'),
+        index=None,
+    )
+    pca = pd.DataFrame(rng.normal(size=(cells, 10)), columns=['PC-%d' % (i + 1) for i in range(10)])
+    pca.insert(0, 'Barcode', barcodes)
+    write_table(pca, os.path.join(analysis, 'pca', '10_components', 'projection.csv'), index=None)
+    fold_change = rng.normal(size=(genes, clusters))
+    pvalue = np.clip(rng.uniform(size=(genes, clusters)) ** 4 / (1 + np.abs(fold_change)), 0, 1)
+    df_diff = pd.concat([
+        pd.DataFrame({'Feature ID': ['ENSG%011d' % i for i in range(genes)], 'Feature Name': names}),
+        pd.DataFrame(fold_change, columns=['Cluster %d Log2 fold change' % c for c in range(clusters)]),
+        pd.DataFrame(pvalue, columns=['Cluster %d Adjusted p value' % c for c in range(clusters)]),
+        pd.DataFrame(rng.gamma(2, size=(genes, clusters)), columns=['Cluster %d Mean Counts' % c for c in range(clusters)]),
+    ], axis=1)
+    write_table(df_diff, os.path.join(analysis, 'diffexp', 'graphclust', 'differential_expression.csv'), index=None)
+    write_table(
+        pd.DataFrame({
+            '#tax_id': 9606,
+            'GeneID': np.arange(genes) + 1,
+            'Symbol': symbols,
+            'Synonyms': np.where(np.arange(genes) % 3 == 0, names, '-'),
+        }),
+        os.path.join(directory, 'gene_info.tsv'),
+        sep='\t',
+        index=None,
+    )
+
+    # app.py inputs, as init.py and example/preinit.py would have written them
+    write_table(
+        pd.DataFrame({'Barcode': barcodes, 'Cluster': cluster, 'UMAP-1': umap[:, 0], 'UMAP-2': umap[:, 1]}),
+        os.path.join(data, 'df_umap.tsv'),
+        sep='\t',
+        index=None,
+    )
+    df_metadata = pd.DataFrame({'Barcode': barcodes})
+    for i in range(metadata_columns):
+        if i % 2 == 0:
+            df_metadata['feature_%d' % i] = rng.normal(loc=cluster * (i % 4), size=cells)
+        else:
+            df_metadata['category_%d' % i] = np.char.add('level_', rng.integers(5, size=cells).astype(str))
+    write_table(df_metadata, os.path.join(data, 'metadata.csv'), index=None)
+    write_table(
+        pd.DataFrame(
+            rng.uniform(size=(metadata_columns, clusters)),
+            index=df_metadata.columns[1:],
+            columns=[str(c) for c in range(clusters)],
+        ),
+        os.path.join(data, 'cluster_aucs.csv'),
+    )
+    library_names = ['Library_%d' % i for i in range(libraries)]
+    n = clusters * 2 * libraries * top_n_results
+    df_enrich = pd.DataFrame({
+        'rank': np.tile(np.arange(top_n_results) + 1, n // top_n_results),
+        'term': ['term %d' % i for i in rng.integers(1000, size=n)],
+        'pvalue': np.sort(rng.uniform(size=(n // top_n_results, top_n_results)) ** 4, axis=1).ravel(),
+        'zscore': rng.normal(size=n),
+        'combinedscore': rng.gamma(2, size=n),
+        'overlapping_genes': [str(list(symbols[rng.integers(genes, size=5)])) for _ in range(n)],
+        'adjusted_pvalue': rng.uniform(size=n),
+    })
+    df_enrich[''] = 0
+    df_enrich[' '] = 0
+    df_enrich['link'] = ''
+    df_enrich['library'] = np.tile(np.repeat(library_names, top_n_results), clusters * 2)
+    df_enrich['category'] = np.tile(np.repeat([categories[i % len(categories)] for i in range(libraries)], top_n_results), clusters * 2)
+    df_enrich['direction'] = np.tile(np.repeat(['up', 'down'], libraries * top_n_results), clusters)
+    df_enrich['cluster'] = np.repeat(np.arange(clusters), 2 * libraries * top_n_results)
+    write_table(
+        df_enrich.rename(columns={' ': ''}),
+        os.path.join(data, 'df_enrich.tsv'),
+        sep='\t',
+        index=None,
+    )
+    df_diff['Symbol'] = symbols
+    write_table(df_diff.drop(columns='Feature ID'), os.path.join(data, 'df.tsv'), sep='\t', index=None)
+    return {
+        'analysis': analysis,
+        'data': data,
+        'gene_info': os.path.join(directory, 'gene_info.tsv'),
+    }
+
+def add_arguments(parser):
+    parser.add_argument('--cells', type=int, default=10000)
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--clusters', type=int, default=10)
+    parser.add_argument('--metadata-columns', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser
+
+if __name__ == '__main__':
+    parser = add_arguments(argparse.ArgumentParser(description=__doc__.splitlines()[0]))
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    print(json.dumps(write_cohort(
+        args.directory,
+        cells=args.cells,
+        genes=args.genes,
+        clusters=args.clusters,
+        metadata_columns=args.metadata_columns,
+        seed=args.seed,
+    ), indent=2))
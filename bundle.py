@@ -0,0 +1,139 @@
+''' Columnar binary bundle of the DATA directory.
+
+`python3 bundle.py data` converts the text tables in `data` into uncompressed Arrow IPC files
+under `data/bundle/` plus a small `manifest.json`. `app.py` memory-maps these when present
+and up to date, and falls back to the TSV/CSV files otherwise.
+'''
+import os
+import sys
+import json
+import pandas as pd
+
+BUNDLE_VERSION = 1
+
+TABLES = {
+    'df': dict(filename='df.tsv', sep='\t', index_col=None),
+    'df_umap': dict(filename='df_umap.tsv', sep='\t', index_col='Barcode'),
+    'df_enrich': dict(filename='df_enrich.tsv', sep='\t', index_col=None),
+    'df_metadata': dict(filename='metadata.csv', sep=',', index_col='Barcode'),
+    'df_cluster_aucs': dict(filename='cluster_aucs.csv', sep=',', index_col=0),
+}
+
+def bundle_path(directory, *paths):
+    return os.path.join(directory, 'bundle', *paths)
+
+def source_stamp(path):
+    ''' Cheap fingerprint of a text table used to detect a stale bundle
+    '''
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def read_manifest(directory):
+    try:
+        with open(bundle_path(directory, 'manifest.json'), 'r') as fr:
+            manifest = json.load(fr)
+    except FileNotFoundError:
+        return None
+    if manifest.get('version') != BUNDLE_VERSION:
+        return None
+    return manifest
+
+def write_manifest(directory, manifest):
+    tmp = bundle_path(directory, 'manifest.json.tmp')
+    with open(tmp, 'w') as fw:
+        json.dump(manifest, fw, indent=2)
+    os.replace(tmp, bundle_path(directory, 'manifest.json'))
+
+def read_text_table(directory, name):
+    spec = TABLES[name]
+    df = pd.read_csv(
+        os.path.join(directory, spec['filename']),
+        sep=spec['sep'],
+        index_col=spec['index_col'],
+    )
+    df.index = df.index.astype(str)
+    df.columns = df.columns.astype(str)
+    return df
+
+def read_bundle_table(directory, name, manifest):
+    ''' Memory-map an Arrow table from the bundle, None if it is missing or stale.
+    Numeric columns are handed to pandas without copying, so workers share their pages
+    through the OS cache.
+    '''
+    import pyarrow as pa
+    entry = manifest['tables'].get(name)
+    if entry is None:
+        return None
+    source = os.path.join(directory, TABLES[name]['filename'])
+    if os.path.exists(source) and source_stamp(source) != entry['source']:
+        return None
+    with pa.memory_map(bundle_path(directory, entry['path']), 'r') as mm:
+        table = pa.ipc.open_file(mm).read_all()
+    return table.to_pandas(split_blocks=True)
+
+def read_table(directory, name):
+    ''' Read a DATA table, preferring the columnar bundle over the text file
+    '''
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        df = read_bundle_table(directory, name, manifest)
+        if df is not None:
+            return df
+    return read_text_table(directory, name)
+
+def table_stamp(directory, name):
+    ''' Fingerprint of everything `read_table` may read a table from, compared to detect changes
+    '''
+    source = os.path.join(directory, TABLES[name]['filename'])
+    manifest = read_manifest(directory)
+    entry = manifest['tables'].get(name) if manifest is not None else None
+    arrow = bundle_path(directory, entry['path']) if entry is not None else None
+    return {
+        'source': source_stamp(source) if os.path.exists(source) else None,
+        'bundle': entry,
+        'arrow': source_stamp(arrow) if arrow is not None and os.path.exists(arrow) else None,
+    }
+
+def stale_tables(directory):
+    ''' Tables with a text file that the bundle does not hold or holds an older version of
+    '''
+    manifest = read_manifest(directory)
+    entries = manifest['tables'] if manifest is not None else {}
+    return [
+        name
+        for name, spec in TABLES.items()
+        if os.path.exists(os.path.join(directory, spec['filename']))
+        and (name not in entries or entries[name]['source'] != source_stamp(os.path.join(directory, spec['filename'])))
+    ]
+
+def write_bundle(directory, names=None):
+    ''' Parse the text tables in `directory` once and store them as Arrow IPC files.
+    Tables are typed exactly as the text readers type them, string index and columns included.
+    '''
+    import pyarrow as pa
+    os.makedirs(bundle_path(directory), exist_ok=True)
+    manifest = read_manifest(directory) or {'version': BUNDLE_VERSION, 'tables': {}}
+    for name, spec in TABLES.items():
+        if names is not None and name not in names:
+            continue
+        source = os.path.join(directory, spec['filename'])
+        if not os.path.exists(source):
+            continue
+        stamp = source_stamp(source)
+        df = read_text_table(directory, name)
+        table = pa.Table.from_pandas(df, preserve_index=None)
+        path = name + '.arrow'
+        with pa.OSFile(bundle_path(directory, path + '.tmp'), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(bundle_path(directory, path + '.tmp'), bundle_path(directory, path))
+        manifest['tables'][name] = {
+            'path': path,
+            'rows': table.num_rows,
+            'source': stamp,
+        }
+        write_manifest(directory, manifest)
+    return manifest
+
+if __name__ == '__main__':
+    write_bundle(sys.argv[1])
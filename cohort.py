@@ -0,0 +1,422 @@
+''' Cohorts served by app.py: one DATA directory each, loaded lazily and cached.
+
+A `Cohort` holds the tables of its directory along with every index app.py serves
+from, all built once when the cohort is loaded. `CohortCache` keeps the most recently
+used cohorts in memory within a budget, evicting the least recently used first.
+'''
+import os
+import time
+import functools
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from bundle import TABLES, bundle_path, read_table, table_stamp
+from columnar import encode_points
+
+def build_points(df_umap, df_metadata):
+    ''' Points of the scatter board with their metadata, addressed by integer position
+    '''
+    return pd.merge(left=df_umap, left_index=True, right=df_metadata, right_index=True)
+
+enrichment_columns = ['rank', 'direction', 'term', 'category', 'pvalue', 'library']
+
+def build_enrichment_index(df_enrich):
+    ''' cluster -> (enrichr link, enrichment table rows pre-sorted by pvalue)
+    The link is None for results computed offline by init.py
+    '''
+    return {
+        cluster: (
+            matches['link'].iloc[0] if pd.notna(matches['link'].iloc[0]) else None,
+            matches[enrichment_columns].sort_values('pvalue', kind='mergesort', ignore_index=True),
+        )
+        for cluster, matches in df_enrich.groupby('cluster', sort=False)
+    }
+
+def build_summary_index(df_cluster_aucs):
+    ''' cluster column -> AUC summary rows sorted by that cluster's AUC
+    '''
+    df_summary = df_cluster_aucs.reset_index().rename({ 'index': 'attribute' }, axis=1)
+    return {
+        col: df_summary.sort_values(col, ascending=False, kind='mergesort', ignore_index=True)
+        for col in df_cluster_aucs.columns
+    }
+
+class PointIndex:
+    ''' Uniform grid over the UMAP coordinates with a fixed random priority per point.
+    Viewport queries only visit the grid columns in view. When more than `limit` points
+    are visible, the `limit` with the lowest priority are served: a uniform sample that
+    keeps the density of the cloud and stays stable while zooming in and out.
+    '''
+    def __init__(self, x, y, bins=256, seed=42):
+        self.x, self.y, self.bins = x, y, bins
+        self.x0, self.x1 = x.min(), x.max()
+        self.y0, self.y1 = y.min(), y.max()
+        cells = self.bin_x(x) * bins + self.bin_y(y)
+        self.order = np.argsort(cells, kind='stable')
+        self.cells = cells[self.order]
+        self.priority = np.random.default_rng(seed).random(x.shape[0])
+
+    def bin_x(self, x):
+        return np.clip(((x - self.x0) / ((self.x1 - self.x0) or 1) * self.bins).astype(int), 0, self.bins - 1)
+
+    def bin_y(self, y):
+        return np.clip(((y - self.y0) / ((self.y1 - self.y0) or 1) * self.bins).astype(int), 0, self.bins - 1)
+
+    def query(self, bounds=None, limit=None):
+        ''' Positions of at most `limit` points within `bounds` = (x0, x1, y0, y1)
+        '''
+        if bounds is None:
+            positions = np.arange(self.x.shape[0])
+        else:
+            x0, x1, y0, y1 = bounds
+            gx = np.arange(self.bin_x(np.float64(x0)), self.bin_x(np.float64(x1)) + 1)
+            starts = np.searchsorted(self.cells, gx * self.bins + self.bin_y(np.float64(y0)), 'left')
+            ends = np.searchsorted(self.cells, gx * self.bins + self.bin_y(np.float64(y1)), 'right')
+            positions = np.concatenate([self.order[start:end] for start, end in zip(starts, ends)] or [[]]).astype(int)
+            positions = positions[
+                (self.x[positions] >= x0) & (self.x[positions] <= x1)
+                & (self.y[positions] >= y0) & (self.y[positions] <= y1)
+            ]
+        if limit is not None and positions.shape[0] > limit:
+            positions = positions[np.argpartition(self.priority[positions], limit)[:limit]]
+        return np.sort(positions)
+
+class MetadataIndex:
+    ''' Inverted index over the metadata columns for server-side search.
+    Text columns keep sorted (token, row) arrays for prefix lookups by binary search,
+    numeric columns keep their sorted values and rows for range queries.
+    '''
+    def __init__(self, df_metadata, exclude=('orig_id',)):
+        self.barcodes = df_metadata.index.values
+        self.text = {}
+        self.numeric = {}
+        for col in df_metadata.columns:
+            if col in exclude:
+                continue
+            values = df_metadata[col]
+            if pd.api.types.is_numeric_dtype(values):
+                v = values.values.astype(np.float64)
+                rows = np.flatnonzero(~np.isnan(v))
+                rows = rows[np.argsort(v[rows], kind='stable')]
+                self.numeric[col] = (v[rows], rows)
+            else:
+                values = values.dropna().astype(str).str.lower()
+                # the whole value and each of its words are tokens
+                tokens = pd.concat([values, values.str.findall(r'[^\W_]+').explode().dropna()])
+                tokens = tokens[tokens != '']
+                rows = df_metadata.index.get_indexer(tokens.index)
+                order = np.lexsort((rows, tokens.values))
+                self.text[col] = (tokens.values[order].astype(str), rows[order])
+
+    def prefix(self, prefix, columns=None):
+        prefix = prefix.lower()
+        matches = [
+            rows[np.searchsorted(tokens, prefix, 'left'):np.searchsorted(tokens, prefix + '\U0010ffff', 'left')]
+            for col, (tokens, rows) in self.text.items()
+            if columns is None or col in columns
+        ]
+        return np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=int)
+
+    def range(self, column, lo=None, hi=None):
+        values, rows = self.numeric[column]
+        start = 0 if lo is None else np.searchsorted(values, lo, 'left')
+        end = values.shape[0] if hi is None else np.searchsorted(values, hi, 'right')
+        return np.sort(rows[start:end])
+
+    def search(self, query):
+        ''' Rows matching every term of `query`: `text` is a prefix in any text column (or,
+        for a number, also a value of any numeric column), `column:text` a prefix in one
+        column, `column:value` a value and `column:lo..hi` a range of a numeric column
+        (either bound optional). Quote terms with spaces: "Related Feature:10..20".
+        '''
+        import shlex
+        try:
+            terms = shlex.split(query)
+        except ValueError:
+            terms = query.split()
+        result = None
+        for term in terms:
+            column, sep, value = term.rpartition(':')
+            if sep and column in self.numeric:
+                if '..' in value:
+                    lo, _, hi = value.partition('..')
+                    rows = self.range(column, float(lo) if lo else None, float(hi) if hi else None)
+                else:
+                    rows = self.range(column, float(value), float(value))
+            elif sep and column in self.text:
+                rows = self.prefix(value, [column])
+            else:
+                rows = self.prefix(term)
+                try:
+                    number = float(term)
+                except ValueError:
+                    number = None
+                if number is not None and self.numeric:
+                    rows = np.unique(np.concatenate([rows, *(self.range(col, number, number) for col in self.numeric)]))
+            result = rows if result is None else np.intersect1d(result, rows, assume_unique=True)
+        return np.empty(0, dtype=int) if result is None else result
+
+class MetadataStore:
+    ''' Per-barcode metadata as one object array, rows addressed by integer position.
+    Values are stored as python scalars so a row is ready to serialize without pandas.
+    '''
+    def __init__(self, df_metadata):
+        self.positions = {barcode: i for i, barcode in enumerate(df_metadata.index)}
+        self.columns = list(df_metadata.columns)
+        self.attributes = ['Barcode', 'Cluster', *self.columns]
+        self.values = df_metadata.astype(object).to_numpy()
+
+    def records(self, position, Barcode, Cluster):
+        ''' attribute/value rows of the patient panel, in `attributes` order
+        '''
+        return [
+            { 'attribute': attribute, 'value': value }
+            for attribute, value in zip(self.attributes, [Barcode, Cluster, *self.values[position].tolist()])
+        ]
+
+def is_cohort(directory):
+    return os.path.exists(os.path.join(directory, 'df_umap.tsv')) or os.path.exists(bundle_path(directory, 'manifest.json'))
+
+def cohort_directory(root, name):
+    ''' Normalized name and directory of cohort `name` under `root`, `''` being `root` itself.
+    Raises KeyError for names outside of `root` or without cohort data.
+    '''
+    root = os.path.abspath(root)
+    directory = os.path.abspath(os.path.join(root, (name or '').strip('/')))
+    if directory != root and not directory.startswith(root + os.sep):
+        raise KeyError(name)
+    if not is_cohort(directory):
+        raise KeyError(name)
+    return ('' if directory == root else os.path.relpath(directory, root).replace(os.sep, '/')), directory
+
+def list_cohorts(root):
+    ''' Names of all cohorts under `root`, cohorts are not searched for nested cohorts
+    '''
+    names = []
+    for directory, subdirectories, _ in os.walk(root, followlinks=True):
+        if is_cohort(directory):
+            subdirectories.clear()
+            names.append(cohort_directory(root, os.path.relpath(directory, root))[0])
+        else:
+            subdirectories[:] = sorted(d for d in subdirectories if not d.startswith('.'))
+    return names
+
+# derived structures -> (the tables they are built from, the attributes they set)
+DERIVED = OrderedDict([
+    ('metadata', (('df_metadata',), ('metadata_index', 'metadata_store', 'metadata_page'))),
+    ('points', (('df_umap', 'df_metadata'), ('df_points', 'point_index', 'overview', 'overview_positions', 'metadata_positions'))),
+    ('clusters', (('df_umap',), ('cluster_sizes',))),
+    ('enrichment', (('df_enrich',), ('enrichment_index',))),
+    ('summary', (('df_cluster_aucs',), ('summary_index',))),
+])
+
+class Cohort:
+    ''' The tables of one DATA directory and everything app.py derives from them.
+    Given the `previous` load of the same cohort, only tables whose files changed since are
+    read again and only the structures derived from them are rebuilt, the rest is shared.
+    A cohort is never modified once built, a reload is a new `Cohort`.
+    '''
+    def __init__(self, name, directory, max_points=100000, metadata_cache_size=4096, previous=None):
+        self.name = name
+        self.directory = directory
+        self.max_points = max_points
+        self.metadata_cache_size = metadata_cache_size
+        self.load_seconds = OrderedDict()
+        self.stamps = {}
+        changed = set()
+        for table in TABLES:
+            # stamped before reading, a file replaced while it is read is reloaded next time
+            self.stamps[table] = table_stamp(directory, table)
+            if previous is not None and previous.stamps[table] == self.stamps[table]:
+                setattr(self, table, getattr(previous, table))
+            else:
+                setattr(self, table, self.load_table(table))
+                changed.add(table)
+        # self.df_cluster_aucs.loc[:,:] = zscore(self.df_cluster_aucs)
+
+        start = time.perf_counter()
+        self.rebuilt = []
+        for derived, (tables, attributes) in DERIVED.items():
+            if previous is not None and not changed.intersection(tables):
+                for attribute in attributes:
+                    setattr(self, attribute, getattr(previous, attribute))
+            else:
+                getattr(self, 'build_' + derived)()
+                self.rebuilt.append(derived)
+        self.index_seconds = time.perf_counter() - start
+        self.nbytes = self.memory_usage()
+        # responses app.py serialized from this build, see payload.py
+        self.responses = {}
+
+    def load_table(self, name):
+        start = time.perf_counter()
+        table = read_table(self.directory, name)
+        self.load_seconds[name] = time.perf_counter() - start
+        return table
+
+    def changed(self):
+        ''' Tables whose files changed since they were read
+        '''
+        return [
+            table
+            for table, stamp in self.stamps.items()
+            if table_stamp(self.directory, table) != stamp
+        ]
+
+    def build_metadata(self):
+        self.metadata_index = MetadataIndex(self.df_metadata)
+        store = self.metadata_store = MetadataStore(self.df_metadata)
+
+        @functools.lru_cache(maxsize=self.metadata_cache_size)
+        def metadata_page(position, Barcode, Cluster, page_current, page_size):
+            ''' Ready-to-send unsorted, unfiltered metadata-table page of a point
+            '''
+            records = store.records(position, Barcode, Cluster)
+            return records[page_current * page_size:(page_current + 1) * page_size], max(1, -(-len(records) // page_size))
+        self.metadata_page = metadata_page
+
+    def build_points(self):
+        self.df_points = build_points(self.df_umap, self.df_metadata)
+        self.point_index = PointIndex(
+            self.df_points['UMAP-1'].to_numpy(dtype=np.float64),
+            self.df_points['UMAP-2'].to_numpy(dtype=np.float64),
+        )
+        # the layout gets a density preserving overview, full resolution is served per viewport
+        positions = np.arange(self.df_points.shape[0])
+        if positions.shape[0] > self.max_points:
+            positions = self.point_index.query(None, self.max_points)
+        self.overview = encode_points(self.df_points, positions)
+        self.overview_positions = positions
+        # metadata row -> point position, -1 for barcodes without a point
+        self.metadata_positions = self.df_points.index.get_indexer(self.df_metadata.index)
+
+    def overview_mask(self, rows):
+        ''' Which points of the overview, in its order, are at the metadata `rows`
+        '''
+        # barcodes without a point (-1) land in the extra last slot
+        hits = np.zeros(self.df_points.shape[0] + 1, dtype=bool)
+        hits[self.metadata_positions[rows]] = True
+        return hits[self.overview_positions]
+
+    def point(self, position, Barcode=None):
+        ''' Barcode and Cluster of the point at `position`, None if there is no such point
+        or, given the `Barcode` the page knows it by, if it is a different point in this build
+        '''
+        if not 0 <= position < self.df_points.shape[0]:
+            return None
+        if Barcode is not None and self.df_points.index[position] != Barcode:
+            return None
+        return {
+            'index': position,
+            'Barcode': self.df_points.index[position],
+            'Cluster': int(self.df_points['Cluster'].iat[position]),
+        }
+
+    def build_clusters(self):
+        self.cluster_sizes = self.df_umap['Cluster'].value_counts().to_dict()
+
+    def build_enrichment(self):
+        self.enrichment_index = build_enrichment_index(self.df_enrich)
+
+    def build_summary(self):
+        self.summary_index = build_summary_index(self.df_cluster_aucs)
+
+    def figure(self, Barcode=None):
+        return self.overview
+
+    def memory_usage(self):
+        ''' Approximate bytes held by the cohort, the unit of the cache budget
+        '''
+        frames = [
+            self.df, self.df_umap, self.df_enrich, self.df_metadata, self.df_cluster_aucs, self.df_points,
+            *(matches for _, matches in self.enrichment_index.values()),
+            *self.summary_index.values(),
+        ]
+        arrays = [
+            self.point_index.order, self.point_index.cells, self.point_index.priority,
+            self.overview_positions, self.metadata_positions,
+            *(a for arrays in self.metadata_index.text.values() for a in arrays),
+            *(a for arrays in self.metadata_index.numeric.values() for a in arrays),
+        ]
+        nbytes = sum(int(df.memory_usage(index=True, deep=True).sum()) for df in frames)
+        nbytes += sum(a.nbytes for a in arrays)
+        # the store holds the same python scalars as the metadata frame, once more
+        nbytes += int(self.df_metadata.memory_usage(index=False, deep=True).sum())
+        nbytes += sum(len(column.get('data', '')) for column in self.overview['columns'].values())
+        return nbytes
+
+class CohortCache:
+    ''' Cohorts loaded on first access by `load(name, previous=None)`, kept while they fit in `budget` bytes.
+    The least recently used are evicted first, the cohort just loaded is always kept.
+    Concurrent requests for a cohort that is loading wait for that load instead of repeating it.
+    '''
+    def __init__(self, load, budget):
+        self.load = load
+        self.budget = budget
+        self.cohorts = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            cohort = self.cohorts.get(name)
+            if cohort is not None:
+                self.cohorts.move_to_end(name)
+                return cohort
+            loading = self.loading.setdefault(name, threading.Lock())
+        with loading:
+            with self.lock:
+                cohort = self.cohorts.get(name)
+                if cohort is not None:
+                    self.cohorts.move_to_end(name)
+                    return cohort
+            try:
+                cohort = self.load(name)
+            except BaseException:
+                with self.lock:
+                    self.loading.pop(name, None)
+                raise
+            with self.lock:
+                self.loading.pop(name, None)
+                self.cohorts[name] = cohort
+                self.evict()
+        return cohort
+
+    def evict(self):
+        while len(self.cohorts) > 1 and self.nbytes() > self.budget:
+            self.cohorts.popitem(last=False)
+
+    def refresh(self):
+        ''' Rebuild the cached cohorts whose files changed, see `Cohort`. Each is swapped in
+        once completely rebuilt, until then requests are served from the previous build.
+        '''
+        with self.lock:
+            cached = list(self.cohorts.items())
+        for name, cohort in cached:
+            try:
+                if not cohort.changed():
+                    continue
+                updated = self.load(name, previous=cohort)
+            except Exception as e:
+                print('reloading cohort {} failed, keeping the loaded one: {}'.format(name or '(default)', e))
+                continue
+            with self.lock:
+                # unless it was evicted meanwhile
+                if self.cohorts.get(name) is cohort:
+                    self.cohorts[name] = updated
+                    self.evict()
+
+    def watch(self, interval):
+        ''' Refresh every `interval` seconds on a background thread
+        '''
+        def run():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        thread = threading.Thread(target=run, name='cohort-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def nbytes(self):
+        return sum(cohort.nbytes for cohort in self.cohorts.values())
@@ -0,0 +1,49 @@
+''' Columnar wire format of the scatter board's points.
+
+Points are sent as one object of columns instead of one object per point. Coordinates
+are base64 little-endian float32 arrays, the point index a uint32 array, and integer or
+text columns are dictionary encoded: their distinct values once, then a code per point
+in the narrowest unsigned type. The page decodes this into the board's point objects in
+a clientside callback (`decode_points` in app.py).
+'''
+import base64
+import numpy as np
+import pandas as pd
+
+def encode_array(values, dtype):
+    ''' A typed array column, `dtype` names the JavaScript typed array it decodes into
+    '''
+    array = np.asarray(values).astype(np.dtype(dtype).newbyteorder('<'))
+    return {'dtype': dtype, 'data': base64.b64encode(array.tobytes()).decode('ascii')}
+
+def code_dtype(n):
+    ''' Narrowest unsigned type with `n` codes
+    '''
+    return 'uint8' if n <= 2 ** 8 else 'uint16' if n <= 2 ** 16 else 'uint32'
+
+def encode_column(values):
+    ''' float32 for floating point columns, otherwise distinct values and a code per row.
+    Code 0 is reserved for missing values. Columns without repeated values are sent as is.
+    '''
+    if pd.api.types.is_float_dtype(values):
+        return encode_array(values, 'float32')
+    codes, uniques = pd.factorize(values)
+    if len(uniques) == len(values):
+        return {'values': uniques.tolist()}
+    return dict(encode_array(codes + 1, code_dtype(len(uniques) + 1)), values=[None, *uniques.tolist()])
+
+def encode_points(df_points, positions):
+    ''' The points at `positions` of `df_points` (Barcode index, UMAP-1, UMAP-2 and the
+    columns carried along), `index` holds the positions events refer to them by
+    '''
+    rows = df_points.iloc[positions]
+    columns = {
+        'index': encode_array(positions, 'uint32'),
+        'Barcode': encode_column(rows.index.to_series()),
+        'x': encode_array(rows['UMAP-1'], 'float32'),
+        'y': encode_array(rows['UMAP-2'], 'float32'),
+    }
+    for column in rows.columns:
+        if column not in columns and column not in ('UMAP-1', 'UMAP-2'):
+            columns[column] = encode_column(rows[column])
+    return {'length': len(positions), 'columns': columns}
@@ -0,0 +1,142 @@
+import os
+import time
+import json
+import random
+import hashlib
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# statuses worth retrying, anything else is a hard failure
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+  ''' Thread-safe token bucket: on average `rate` acquisitions per second, bursts up to `burst`
+  '''
+  def __init__(self, rate, burst=1):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+class ResponseCache:
+  ''' Content-addressed on-disk store of Enrichr responses.
+  Every response is its own file written atomically as soon as it arrives, so a crashed
+  or interrupted run keeps all completed requests and a rerun only issues the rest.
+  '''
+  def __init__(self, directory):
+    self.directory = directory
+
+  def path(self, namespace, *key):
+    digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+    return os.path.join(self.directory, namespace, digest[:2], digest + '.json')
+
+  def get(self, namespace, *key):
+    try:
+      with open(self.path(namespace, *key), 'r') as fr:
+        return json.load(fr)
+    except FileNotFoundError:
+      return None
+
+  def put(self, namespace, *key, value):
+    path = self.path(namespace, *key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as fw:
+      json.dump(value, fw)
+    os.replace(tmp, path)
+    return value
+
+class EnrichrClient:
+  ''' Functional access to Enrichr API over a shared connection pool.
+  Requests may be issued from many threads; the token bucket keeps the aggregate
+  rate within what the server allows and transient failures are retried with
+  exponential backoff. Given a `cache`, identical gene lists and (userListId, library)
+  pairs are answered from disk instead of resubmitted.
+  '''
+  def __init__(self, enrichr_link='https://amp.pharm.mssm.edu/Enrichr', rate=2, burst=1, max_workers=4, retries=5, backoff=1, timeout=60, cache=None):
+    import requests
+    from requests.adapters import HTTPAdapter
+    self.enrichr_link = enrichr_link
+    self.bucket = TokenBucket(rate, burst)
+    self.max_workers = max_workers
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.cache = cache
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def request(self, method, path, **kwargs):
+    import requests
+    for attempt in range(self.retries + 1):
+      self.bucket.acquire()
+      retry_after = None
+      try:
+        resp = self.session.request(method, self.enrichr_link + path, timeout=self.timeout, **kwargs)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        error = e
+      else:
+        if resp.status_code == 200:
+          return resp
+        error = Exception('Enrichr failed with status {}: {}'.format(
+          resp.status_code,
+          resp.text,
+        ))
+        if resp.status_code not in RETRY_STATUS:
+          raise error
+        retry_after = resp.headers.get('Retry-After')
+      if attempt < self.retries:
+        if retry_after is not None and retry_after.isdigit():
+          time.sleep(float(retry_after))
+        else:
+          time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+    raise error
+
+  def add_list(self, genes, description=''):
+    gene_list = '\n'.join(genes)
+    key = (self.enrichr_link, hashlib.sha256(gene_list.encode()).hexdigest(), description)
+    result = self.cache.get('addList', *key) if self.cache else None
+    if result is None:
+      resp = self.request('POST', '/addList', files={
+        'list': (None, gene_list),
+        'description': (None, description),
+      })
+      result = resp.json()
+      if self.cache:
+        self.cache.put('addList', *key, value=result)
+    return dict(result, link=self.enrichr_link + '/enrich?dataset=' + result['shortId'])
+
+  def get_top_results(self, userListId, bg):
+    key = (self.enrichr_link, userListId, bg)
+    result = self.cache.get('enrich', *key) if self.cache else None
+    if result is None:
+      resp = self.request('GET', '/enrich', params={
+        'userListId': userListId,
+        'backgroundType': bg,
+      })
+      result = resp.json()[bg]
+      if self.cache:
+        self.cache.put('enrich', *key, value=result)
+    return pd.DataFrame(result, columns=['rank', 'term', 'pvalue', 'zscore', 'combinedscore', 'overlapping_genes', 'adjusted_pvalue', '', ''])
+
+  def map(self, func, iterable):
+    ''' Run `func` over `iterable` on a bounded thread pool, results in input order
+    '''
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      return list(executor.map(func, iterable))
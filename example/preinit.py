@@ -7,39 +7,76 @@ import plotly.express as px
 from IPython.display import display
 from matplotlib import pyplot as plt
 from umap import UMAP
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.decomposition import PCA
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics import silhouette_score
 from maayanlab_bioinformatics.dge import characteristic_direction
-from maayanlab_bioinformatics.normalization import log2_normalize, filter_by_var, zscore_normalize
+from maayanlab_bioinformatics.normalization import zscore_normalize
 from maayanlab_bioinformatics.utils import merge
 
 #%%
-df_data = pd.read_csv('data.csv', index_col=0)
-df_data.columns = df_data.columns.astype(str)
-df_data.columns.name = 'Barcode'
+def read_expression(path, chunk_bytes=2 ** 28):
+  ''' Read a genes x cells count matrix as a sparse CSR matrix plus its gene and barcode labels.
+
+  MatrixMarket input (10x `matrix.mtx[.gz]` next to `features.tsv[.gz]` or `genes.tsv[.gz]`
+  and `barcodes.tsv[.gz]`) is read directly, CSV input is streamed as many genes at a time as
+  fit densely in `chunk_bytes`, so peak memory follows the non-zero count and not the cohort size.
+  '''
+  import scipy.sparse as sp
+  if '.mtx' in os.path.basename(path):
+    from scipy.io import mmread
+    find = lambda *names: next(
+      os.path.join(os.path.dirname(path), name)
+      for name in names
+      if os.path.exists(os.path.join(os.path.dirname(path), name))
+    )
+    X = sp.csr_matrix(mmread(path))
+    genes = pd.read_csv(find('features.tsv.gz', 'features.tsv', 'genes.tsv.gz', 'genes.tsv'), sep='\t', header=None)[1].values
+    barcodes = pd.read_csv(find('barcodes.tsv.gz', 'barcodes.tsv'), sep='\t', header=None)[0].values
+  else:
+    barcodes = pd.read_csv(path, index_col=0, nrows=0).columns.values
+    chunksize = max(1, chunk_bytes // (8 * max(1, len(barcodes))))
+    blocks, genes = [], []
+    for chunk in pd.read_csv(path, index_col=0, chunksize=chunksize):
+      blocks.append(sp.csr_matrix(chunk.values))
+      genes.append(chunk.index.values)
+    X = sp.vstack(blocks, format='csr')
+    genes = np.concatenate(genes)
+  return X, pd.Index(genes), pd.Index(barcodes.astype(str), name='Barcode')
+
+X_data, genes, barcodes = read_expression('data.csv')
 metadata = pd.read_csv('metadata.csv', index_col=0)
 metadata.index = metadata.index.astype(str)
 metadata['Labels'] = metadata['Labels'].astype(str)
 
 #%%
+n_reads = np.asarray((X_data > 0).sum(axis=0)).ravel()
 df_library_size = pd.DataFrame(
     {
-        'n_reads': df_data[df_data > 0].count(),
-        'log_n_reads': np.log2(df_data[df_data > 0].count() + 1),
-        'n_expressed_genes': df_data.sum(),
-    }
+        'n_reads': n_reads,
+        'log_n_reads': np.log2(n_reads + 1),
+        'n_expressed_genes': np.asarray(X_data.sum(axis=0)).ravel(),
+    },
+    index=barcodes,
 ).sort_values('n_reads', ascending=False)
 
 display(df_library_size.head())
-sns.distplot(df_data.iloc[0, :]); plt.show()
-sns.distplot(df_data.iloc[:, 0]); plt.show()
+sns.distplot(X_data[0, :].toarray().ravel()); plt.show()
+sns.distplot(X_data[:, 0].toarray().ravel()); plt.show()
 
 #%%
-df_data_norm = filter_by_var(df_data)
-df_data_norm = log2_normalize(df_data_norm)
+# Variance filter and log2 normalization on the sparse matrix, only the top genes are made dense
+top_n_genes = 2500
+mean = np.asarray(X_data.mean(axis=1)).ravel()
+mean_sq = np.asarray(X_data.multiply(X_data).mean(axis=1)).ravel()
+var = (mean_sq - mean ** 2) * X_data.shape[1] / (X_data.shape[1] - 1)
+top_genes = np.argsort(-var, kind='stable')[:top_n_genes]
+# log2(x + 1) keeps zeros at zero
+X_data_norm = X_data[top_genes].log1p() / np.log(2)
+df_data_norm = pd.DataFrame(X_data_norm.toarray(), index=genes[top_genes], columns=barcodes)
 df_data_norm = zscore_normalize(df_data_norm)
 
 #%%
@@ -106,10 +143,41 @@ px.scatter(
 )
 
 #%%
-silhouette_scores = {}
-for n in range(2, 25):
-    y_pred = KMeans(n_clusters=n, random_state=42).fit_predict(df_data_norm_umap.values)
-    silhouette_scores[n] = silhouette_score(df_data_norm_umap.values, y_pred, metric='cosine')
+# Cluster count selection, fits run in parallel across a process pool.
+#  For large cohorts set silhouette_sample_size: clusters are then fit with MiniBatchKMeans
+#  and the (quadratic) silhouette is scored on a stratified subsample of that many cells.
+n_clusters_range = range(2, 25)
+silhouette_sample_size = None
+silhouette_seed = 42
+n_jobs = -1
+
+def stratified_sample(y, sample_size, seed):
+  ''' Indices of about `sample_size` cells, every label keeping its share (at least one cell)
+  '''
+  rng = np.random.default_rng(seed)
+  frac = min(1., sample_size / len(y))
+  order = np.argsort(y, kind='stable')
+  labels, starts = np.unique(y[order], return_index=True)
+  return np.sort(np.concatenate([
+    rng.choice(members, size=max(1, int(round(len(members) * frac))), replace=False)
+    for members in np.split(order, starts[1:])
+  ]))
+
+def score_n_clusters(X, n, sample_size=None, seed=42):
+  if sample_size is None:
+    y_pred = KMeans(n_clusters=n, random_state=42).fit_predict(X)
+    return silhouette_score(X, y_pred, metric='cosine')
+  y_pred = MiniBatchKMeans(n_clusters=n, random_state=42).fit_predict(X)
+  sample = stratified_sample(y_pred, sample_size, seed)
+  return silhouette_score(X[sample], y_pred[sample], metric='cosine')
+
+silhouette_scores = dict(zip(
+  n_clusters_range,
+  Parallel(n_jobs=n_jobs)(
+    delayed(score_n_clusters)(df_data_norm_umap.values, n, silhouette_sample_size, silhouette_seed)
+    for n in n_clusters_range
+  ),
+))
 
 silhouette_scores = pd.DataFrame([
     {'N Clusters': k, 'Silhouette Score': v}
@@ -128,7 +196,7 @@ plt.xlabel('Number of Clusters')
 plt.show()
 
 #%%
-km = KMeans(n_clusters=int(best['N Clusters']), random_state=42)
+km = (KMeans if silhouette_sample_size is None else MiniBatchKMeans)(n_clusters=int(best['N Clusters']), random_state=42)
 df_data_norm_km = pd.DataFrame({
     'Cluster': [
         str(c)
@@ -137,34 +205,128 @@ df_data_norm_km = pd.DataFrame({
 }, index=df_data_norm_umap.index)
 
 #%%
-# Perform differential expression for each cluter
-diff_expr = {}
-for cluster, samples in df_data_norm_km.groupby('Cluster'):
-  diff_expr[cluster] = characteristic_direction(
-    # expression outside of this cluster
-    df_data_norm.loc[:, df_data_norm.columns.difference(samples.index)],
-    # expression in this cluster
-    df_data_norm.loc[:, samples.index],
-  )['CD-coefficient']
+# Perform differential expression for every cluster against the rest at once
+def cd_chunk(X, codes, clusters, V, shrunk):
+  ''' Unnormalized characteristic directions of a chunk of clusters from the shared decomposition
+  '''
+  onehot = (codes[:, np.newaxis] == clusters[np.newaxis, :]).astype(X.dtype)
+  n_in = onehot.sum(axis=0)
+  sums = X @ onehot
+  total = X.sum(axis=1, keepdims=True)
+  # mean expression in the cluster minus mean expression outside of it
+  meanvec = sums / n_in - (total - sums) / (X.shape[1] - n_in)
+  return V @ (shrunk @ (V.T @ meanvec))
+
+def characteristic_directions(df_data_norm, clusters, gamma=1., n_jobs=None):
+  ''' Characteristic direction of each cluster vs the rest, for all clusters together.
 
-df_diff_expr = pd.DataFrame(diff_expr)
+  Cases and controls always make up every cell, so the PCA and the pooled covariance in
+  PC space (and so the shrunk inverse) are the same for every cluster, only the difference
+  of means changes. Those come from integer cluster codes, no sub-frames are copied, and
+  chunks of clusters can be spread over a process pool with `n_jobs`.
+  '''
+  X = df_data_norm.values
+  codes, labels = pd.factorize(clusters.reindex(df_data_norm.columns), sort=True)
+  pca = PCA(n_components=None)
+  R = pca.fit_transform(X.T)
+  keep = int((pca.explained_variance_ratio_ > 0.001).sum())
+  V = pca.components_[:keep].T
+  R = R[:, :keep]
+  dd = R.T @ R / float(X.shape[1] - 2)
+  sigma = np.mean(np.diag(dd))
+  shrunk = np.linalg.inv(gamma * dd + sigma * (1 - gamma) * np.eye(keep))
+  n_chunks = min(len(labels), effective_n_jobs(n_jobs)) if n_jobs else 1
+  B = np.concatenate(Parallel(n_jobs=n_jobs)(
+    delayed(cd_chunk)(X, codes, chunk, V, shrunk)
+    for chunk in np.array_split(np.arange(len(labels)), n_chunks)
+  ), axis=1)
+  B /= np.linalg.norm(B, axis=0)
+  return pd.DataFrame(
+    B,
+    index=df_data_norm.index,
+    columns=[f'Cluster {cluster} CD' for cluster in labels],
+  )
+
+df_diff_expr = characteristic_directions(df_data_norm, df_data_norm_km['Cluster'])
 df_diff_expr.index.name = 'Feature Name'
 
 #%%
-df_diff_expr['Cluster 0'].sort_values(ascending=True)
+# Check the batched computation against characteristic_direction on one cluster
+cluster = df_data_norm_km['Cluster'].iloc[0]
+in_cluster = (df_data_norm_km['Cluster'] == cluster).reindex(df_data_norm.columns).values
+cd = characteristic_direction(
+  # expression outside of this cluster
+  df_data_norm.iloc[:, np.flatnonzero(~in_cluster)],
+  # expression in this cluster
+  df_data_norm.iloc[:, np.flatnonzero(in_cluster)],
+)['CD-coefficient']
+np.corrcoef(cd.loc[df_diff_expr.index], df_diff_expr[f'Cluster {cluster} CD'])[0, 1]
+
+#%%
+df_diff_expr['Cluster 0 CD'].sort_values(ascending=True)
 #%%
-aucs = {}
-for cluster, samples in df_data_norm_km.groupby('Cluster'):
-  aucs[cluster] = {}
+def cluster_aucs(metadata, clusters):
+  ''' AUC of every metadata feature for predicting membership of every cluster.
+
+  A logistic regression on a single feature scores cells monotonically in that feature,
+  so its AUC is the rank-based (Mann-Whitney) AUC of the raw feature in the better of
+  its two orientations. One ranking per feature therefore serves every cluster.
+  NaNs are left out per feature. Categories have no order to rank by, so a non-numeric
+  feature is scored one-vs-rest: an indicator per category, reported as `feature=category`.
+  '''
+  metadata = metadata.reindex(clusters.index)
+  X = {}
   for feature in metadata.columns:
+    try:
+      X[feature] = pd.to_numeric(metadata[feature])
+    except (ValueError, TypeError):
+      values = metadata[feature]
+      for category in values.dropna().unique():
+        X[f'{feature}={category}'] = (values == category).astype(np.float64).where(values.notna())
+  X = pd.DataFrame(X, index=metadata.index)
+  valid = X.notna().values.astype(np.float64)
+  ranks = X.rank().fillna(0).values
+  codes, labels = pd.factorize(clusters, sort=True)
+  onehot = np.eye(len(labels))[codes]
+  # cells in / out of each cluster with a value, per feature
+  n_pos = valid.T @ onehot
+  n_neg = valid.sum(axis=0)[:, np.newaxis] - n_pos
+  U = ranks.T @ onehot - n_pos * (n_pos + 1) / 2
+  with np.errstate(divide='ignore', invalid='ignore'):
+    auc = U / (n_pos * n_neg)
+  return pd.DataFrame(np.maximum(auc, 1 - auc), index=X.columns, columns=labels)
+
+pd_aucs = cluster_aucs(metadata, df_data_norm_km['Cluster'])
+pd_aucs
+
+#%%
+# Check the closed form against the single feature LogisticRegression it replaces
+#  on a few complete numeric features and category indicators (LogisticRegression needs numbers)
+checked_numeric, checked_indicators = {}, {}
+for feature in metadata.columns:
+  values = metadata.loc[df_data_norm_km.index, feature]
+  if values.isna().any():
+    continue
+  numeric = pd.to_numeric(values, errors='coerce')
+  if numeric.notna().all():
+    checked_numeric[feature] = numeric
+  else:
+    category = values.iloc[0]
+    checked_indicators[f'{feature}={category}'] = (values == category).astype(np.float64)
+checked = dict(list(checked_numeric.items())[:5] + list(checked_indicators.items())[:5])
+lr_aucs = {}
+for cluster in pd_aucs.columns:
+  lr_aucs[cluster] = {}
+  for feature, values in checked.items():
     lr = LogisticRegression()
-    X = metadata.loc[:, feature].values[:, np.newaxis]
+    X = values.values[:, np.newaxis]
     y_true = (df_data_norm_km['Cluster'] == cluster).astype(np.int64)
     lr.fit(X, y_true)
     y_score = lr.predict_proba(X)[:, 1]
-    aucs[f"Cluster {cluster} CD"][feature] = roc_auc_score(y_true, y_score)
+    lr_aucs[cluster][feature] = roc_auc_score(y_true, y_score)
 
-pd_aucs = pd.DataFrame(aucs)
+lr_aucs = pd.DataFrame(lr_aucs)
+assert np.allclose(lr_aucs, pd_aucs.loc[lr_aucs.index, lr_aucs.columns])
 
 #%%
 # /clustering/graphclust/clusters.csv
@@ -1,12 +1,18 @@
 import os
 import sys
+import json
+import functools
+import numpy as np
 import pandas as pd
 from collections import OrderedDict
+from enrichr import EnrichrClient, ResponseCache
+from pipeline import Pipeline, fingerprint, file_stamp
 
 base_path = sys.argv[1]
 output = sys.argv[2]
 
 n_genes = 250
+ncbi_lookup_version = 1
 top_n_results = 5
 useful_libs = OrderedDict([
   ('Diseases', ['UK_Biobank_GWAS_v1', 'GWAS_Catalog_2019', 'DisGeNET']),
@@ -16,147 +22,311 @@ useful_libs = OrderedDict([
   ('Transcription', ['ARCHS4_TFs_Coexp', 'ENCODE_and_ChEA_Consensus_TFs_from_ChIP-X']),
 ])
 
-# Load data
-df = pd.read_csv(base_path + '/diffexp/graphclust/differential_expression.csv')
-df_umap = pd.read_csv(base_path + '/umap/2_components/projection.csv')
-df_pca = pd.read_csv(base_path + '/pca/10_components/projection.csv')
-df_clusters = pd.read_csv(base_path + '/clustering/graphclust/clusters.csv')
-df_clusters['Cluster'] = df_clusters['Cluster'].astype(str)
+# Stages are cached under output/.pipeline and rerun only when their inputs change,
+#  their timings are printed and written as JSON to INIT_TIMINGS when set (see benchmark/)
+pipeline = Pipeline(output)
 
-# Util functions
-def enrichr_link_from_genes(genes, description='', enrichr_link='https://amp.pharm.mssm.edu/Enrichr'):
-  ''' Functional access to Enrichr API
-  '''
-  import time, requests
-  time.sleep(1)
-  resp = requests.post(enrichr_link + '/addList', files={
-    'list': (None, '\n'.join(genes)),
-    'description': (None, description),
-  })
-  if resp.status_code != 200:
-    raise Exception('Enrichr failed with status {}: {}'.format(
-      resp.status_code,
-      resp.text,
-    ))
-  # wait a tinybit before returning link (backoff)
-  time.sleep(1)
-  result = resp.json()
-  return dict(result, link=enrichr_link + '/enrich?dataset=' + resp.json()['shortId'])
-
-def enrichr_get_top_results(userListId, bg, enrichr_link='https://amp.pharm.mssm.edu/Enrichr'):
-  import time, requests
-  time.sleep(1)
-  resp = requests.get(enrichr_link + '/enrich?userListId={}&backgroundType={}'.format(userListId, bg))
-  if resp.status_code != 200:
-    raise Exception('Enrichr failed with status {}: {}'.format(
-      resp.status_code,
-      resp.text,
-    ))
-  time.sleep(1)
-  return pd.DataFrame(resp.json()[bg], columns=['rank', 'term', 'pvalue', 'zscore', 'combinedscore', 'overlapping_genes', 'adjusted_pvalue', '', ''])
-
-
-# Merge data
-df_clustered_umap = pd.merge(left=df_clusters, left_on='Barcode', right=df_umap, right_on='Barcode')
-df_clustered_pca = pd.merge(left=df_clusters, left_on='Barcode', right=df_pca, right_on='Barcode')
+diffexp_path = base_path + '/diffexp/graphclust/differential_expression.csv'
+umap_path = base_path + '/umap/2_components/projection.csv'
+clusters_path = base_path + '/clustering/graphclust/clusters.csv'
+
+# Enrichr client, point ENRICHR_URL at a local stand-in server for testing
+#  responses are cached on disk so reruns and crashed runs resume where they stopped
+enrichr = EnrichrClient(
+  os.environ.get('ENRICHR_URL', 'https://amp.pharm.mssm.edu/Enrichr'),
+  rate=json.loads(os.environ.get('ENRICHR_RATE', '2')),
+  max_workers=json.loads(os.environ.get('ENRICHR_WORKERS', '4')),
+  cache=ResponseCache(os.environ.get('ENRICHR_CACHE', os.path.join(output, '.enrichr_cache'))),
+)
+
+# Load and merge clusters & umap
+def load_umap():
+  df_umap = pd.read_csv(umap_path)
+  df_clusters = pd.read_csv(clusters_path)
+  df_clusters['Cluster'] = df_clusters['Cluster'].astype(str)
+  return pd.merge(left=df_clusters, left_on='Barcode', right=df_umap, right_on='Barcode')
+
+umap_stage = pipeline.stage('umap', [file_stamp(umap_path), file_stamp(clusters_path)], load_umap)
 
 # Grab ncbi symbols
-ncbi = pd.read_csv('ftp://ftp.ncbi.nih.gov/gene/DATA/GENE_INFO/Mammalia/Homo_sapiens.gene_info.gz', sep='\t')
-# Ensure nulls are treated as such
-ncbi = ncbi.applymap(lambda v: float('nan') if type(v) == str and v == '-' else v)
-# Break up lists
-split_list = lambda v: v.split('|') if type(v) == str else []
-ncbi['dbXrefs'] = ncbi['dbXrefs'].apply(split_list)
-ncbi['Synonyms'] = ncbi['Synonyms'].apply(split_list)
-ncbi['LocusTag'] = ncbi['LocusTag'].apply(split_list)
-ncbi['Other_designations'] = ncbi['Other_designations'].apply(split_list)
-# Map existing entities to NCBI Genes
-ncbi_lookup = {
-  sym.upper(): row['Symbol'].upper()
-  for _, row in ncbi.iterrows()
-  for sym in [row['Symbol']] + row['Synonyms']
-}
-df['Symbol'] = df['Feature Name'].map(lambda s: ncbi_lookup.get(s.upper()))
+def build_ncbi_lookup(gene_info):
+  ''' Map upper-case symbols and synonyms to official NCBI symbols.
+  Entries are ordered (row, symbol before synonyms) and the last one wins, as with the
+  original dict comprehension over `ncbi.iterrows()`.
+  '''
+  ncbi = pd.read_csv(gene_info, sep='\t', usecols=['Symbol', 'Synonyms'], na_values=['-'], dtype=str)
+  ncbi = ncbi.dropna(subset=['Symbol'])
+  symbols = ncbi['Symbol'].str.upper()
+  synonyms = ncbi['Synonyms'].str.upper().str.split('|').explode().dropna()
+  lookup = pd.concat([
+    pd.DataFrame({'key': symbols, 'symbol': symbols, 'order': 0}),
+    pd.DataFrame({
+      'key': synonyms,
+      'symbol': symbols.loc[synonyms.index],
+      'order': synonyms.groupby(level=0).cumcount() + 1,
+    }),
+  ]).rename_axis('row').reset_index()
+  lookup = lookup.sort_values(['row', 'order'], kind='mergesort').drop_duplicates('key', keep='last')
+  return dict(zip(lookup['key'], lookup['symbol']))
+
+def remote_stamp(url):
+  ''' Size and modification time of a remote file (ftp via SIZE/MDTM, http(s) via HEAD),
+  None if the server cannot be reached
+  '''
+  from urllib.parse import urlparse
+  parsed = urlparse(url)
+  if parsed.scheme == 'ftp':
+    import ftplib
+    try:
+      with ftplib.FTP(parsed.hostname, timeout=30) as ftp:
+        ftp.login()
+        ftp.voidcmd('TYPE I')
+        return {'size': ftp.size(parsed.path), 'mtime': ftp.voidcmd('MDTM ' + parsed.path).split()[-1]}
+    except (OSError, EOFError, ftplib.Error):
+      return None
+  import requests
+  try:
+    resp = requests.head(url, allow_redirects=True, timeout=30)
+    resp.raise_for_status()
+  except requests.RequestException:
+    return None
+  return {'size': resp.headers.get('Content-Length'), 'mtime': resp.headers.get('Last-Modified')}
+
+@functools.lru_cache(maxsize=None)
+def ncbi_lookup_stamp(gene_info):
+  stamp = {'version': ncbi_lookup_version, 'source': gene_info}
+  if os.path.exists(gene_info):
+    st = os.stat(gene_info)
+    stamp.update(size=st.st_size, mtime=st.st_mtime)
+  else:
+    stamp.update(remote_stamp(gene_info) or {})
+  return stamp
+
+def load_ncbi_lookup(gene_info, cache_path):
+  ''' Load the symbol lookup from its local artifact, (re)building it if missing, unreadable or stale.
+  When the remote source cannot be reached a lookup built from it is reused as is.
+  '''
+  import pickle
+  stamp = ncbi_lookup_stamp(gene_info)
+  try:
+    with open(cache_path, 'rb') as fr:
+      cached = pickle.load(fr)
+    if cached['stamp'] == stamp or ('mtime' not in stamp and all(cached['stamp'].get(k) == v for k, v in stamp.items())):
+      return cached['lookup']
+  except FileNotFoundError:
+    pass
+  except Exception as e:
+    print('ignoring unreadable NCBI lookup cache {}: {}'.format(cache_path, e))
+  lookup = build_ncbi_lookup(gene_info)
+  os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+  with open(cache_path + '.tmp', 'wb') as fw:
+    pickle.dump({'stamp': stamp, 'lookup': lookup}, fw, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(cache_path + '.tmp', cache_path)
+  return lookup
+
+# Map existing entities to NCBI Genes, NCBI_GENE_INFO may point to a local gene_info file to run offline
+gene_info = os.environ.get('NCBI_GENE_INFO', 'ftp://ftp.ncbi.nih.gov/gene/DATA/GENE_INFO/Mammalia/Homo_sapiens.gene_info.gz')
+
+def load_expression():
+  df = pd.read_csv(diffexp_path)
+  ncbi_lookup = load_ncbi_lookup(
+    gene_info,
+    os.environ.get('NCBI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'cohortsEnrichr', 'ncbi_lookup.pkl')),
+  )
+  df['Symbol'] = df['Feature Name'].str.upper().map(ncbi_lookup)
+  return df
+
+expression_stage = pipeline.stage('expression', [file_stamp(diffexp_path), ncbi_lookup_stamp(gene_info)], load_expression)
 
 # Get top Genes for each cluster
-top_genes = {}
-for cluster in df_clustered_umap['Cluster'].unique():
-  fc_col = 'Cluster %s Log2 fold change' % (cluster)
-  p_col = 'Cluster %s Adjusted p value' % (cluster)
-  cd_col = 'Cluster %s CD' % (cluster)
-  if p_col in df.columns:
-    # significant and positive fold change sorted by p value
-    up_genes = df.loc[
-      df[((df[p_col] <= 0.05) & (df[fc_col] > 0))][p_col].sort_values().index,
-      'Symbol'
-    ].iloc[:n_genes].dropna().values
-    # significant and negative fold change sorted by p value
-    dn_genes = df.loc[
-      df[((df[p_col] <= 0.05) & (df[fc_col] < 0))][p_col].sort_values().index,
-      'Symbol'
-    ].iloc[:n_genes].dropna().values
-  elif cd_col in df.columns:
-    # top up genes
-    up_genes = df.loc[df[cd_col].sort_values(ascending=False).iloc[:n_genes].index, 'Symbol'].values
-    # top down genes
-    dn_genes = df.loc[df[cd_col].sort_values(ascending=True).iloc[:n_genes].index, 'Symbol'].values
+def top_n_rows(scores, n):
+  ''' Row positions of the `n` smallest scores in every column, in ascending order.
+  Partial sort: only the selected block of each column is fully sorted.
+  '''
+  n = min(n, scores.shape[0])
+  if n == 0:
+    return np.empty((0, scores.shape[1]), dtype=np.int64)
+  if n < scores.shape[0]:
+    rows = np.argpartition(scores, n - 1, axis=0)[:n]
   else:
+    rows = np.tile(np.arange(scores.shape[0])[:, np.newaxis], (1, scores.shape[1]))
+  order = np.argsort(np.take_along_axis(scores, rows, axis=0), axis=0, kind='stable')
+  return np.take_along_axis(rows, order, axis=0)
+
+def select_top_genes():
+  df = expression_stage.value
+  clusters = umap_stage.value['Cluster'].unique()
+  p_clusters = [cluster for cluster in clusters if 'Cluster %s Adjusted p value' % (cluster) in df.columns]
+  cd_clusters = [cluster for cluster in clusters if cluster not in p_clusters and 'Cluster %s CD' % (cluster) in df.columns]
+  if len(p_clusters) + len(cd_clusters) != len(clusters):
     raise Exception('Cant find col for cluster')
-  # save results
-  top_genes[cluster] = (up_genes, dn_genes)
 
+  symbols = df['Symbol'].values
+  top_genes = {}
+  if p_clusters:
+    # significant genes sorted by p value, all clusters at once
+    P = df[['Cluster %s Adjusted p value' % (cluster) for cluster in p_clusters]].values.astype(np.float64)
+    FC = df[['Cluster %s Log2 fold change' % (cluster) for cluster in p_clusters]].values.astype(np.float64)
+    significant = P <= 0.05
+    for direction in [FC > 0, FC < 0]:
+      scores = np.where(significant & direction, P, np.inf)
+      rows = top_n_rows(scores, n_genes)
+      for k, cluster in enumerate(p_clusters):
+        genes = symbols[rows[np.isfinite(scores[rows[:, k], k]), k]]
+        top_genes.setdefault(cluster, []).append(genes[pd.notna(genes)])
+  if cd_clusters:
+    # top up genes & top down genes by characteristic direction
+    CD = df[['Cluster %s CD' % (cluster) for cluster in cd_clusters]].values.astype(np.float64)
+    for scores in [-CD, CD]:
+      rows = top_n_rows(np.where(np.isnan(scores), np.inf, scores), n_genes)
+      for k, cluster in enumerate(cd_clusters):
+        top_genes.setdefault(cluster, []).append(symbols[rows[:, k]])
+  return {
+    cluster: tuple(top_genes[cluster])
+    for cluster in clusters
+  }
 
-# Get Enrichr links for each cluster
-enrichr_links = {}
+top_genes_stage = pipeline.stage('top_genes', [expression_stage, umap_stage, n_genes], select_top_genes)
 
-for cluster, (up_genes, dn_genes) in top_genes.items():
-  up_link, dn_link = None, None
-  if up_genes.size:
-    up_link = enrichr_link_from_genes(up_genes, 'cluster %s up' % (cluster))
-    # display_link_inline(up_link['link'])
-  else:
-    print('cluster %s up: empty' % (cluster))
-  if dn_genes.size:
-    dn_link = enrichr_link_from_genes(dn_genes, 'cluster %s down' % (cluster))
-    # display_link_inline(dn_link['link'])
-  else:
-    print('cluster %s down: empty' % (cluster))
-  enrichr_links[cluster] = (up_link, dn_link)
-
-# Grab top results for each cluster
-all_results = []
-for cluster, (up_link, dn_link) in enrichr_links.items():
-  for link_type, link in [('up', up_link), ('down', dn_link)]:
-    if link is None:
+def enrich_remote(gene_lists, jobs):
+  ''' Submit the gene lists of `jobs` to Enrichr and grab the top results of each (list, library)
+  '''
+  # Get Enrichr links for each list
+  def get_link(list_key):
+    cluster, link_type = list_key
+    return enrichr.add_list(gene_lists[list_key], 'cluster %s %s' % (cluster, link_type))
+
+  list_keys = list(OrderedDict.fromkeys((cluster, link_type) for cluster, link_type, _, _ in jobs))
+  links = dict(zip(list_keys, enrichr.map(get_link, list_keys)))
+
+  # Grab top results for each list and library
+  def get_top_results(job):
+    cluster, link_type, category, library = job
+    link = links[(cluster, link_type)]
+    try:
+      results = enrichr.get_top_results(link['userListId'], library).sort_values('pvalue').iloc[:top_n_results]
+      results['link'] = link['link']
+      return results
+    except:
+      print('{}: {} {} {} cluster {} failed, continuing'.format(link, library, category, link_type, cluster))
+
+  return {
+    job: results
+    for job, results in zip(jobs, enrichr.map(get_top_results, jobs))
+    if results is not None
+  }
+
+def enrich_local(gene_lists, jobs):
+  ''' Offline enrichment of the lists of `jobs` at once against local GMT copies of their libraries
+  '''
+  from local_enrichr import GeneSetLibrary, enrich
+  computed = {}
+  for category, library in OrderedDict.fromkeys((category, library) for _, _, category, library in jobs):
+    library_lists = OrderedDict(
+      ((cluster, link_type), gene_lists[(cluster, link_type)])
+      for cluster, link_type, _, job_library in jobs
+      if job_library == library
+    )
+    try:
+      results = enrich(GeneSetLibrary.from_gmt(os.path.join(gmt_path, library + '.gmt')), library_lists, top_n=top_n_results)
+    except FileNotFoundError:
+      print('{} {}: no GMT file in {}, continuing'.format(library, category, gmt_path))
       continue
-    for category, libraries in useful_libs.items():
-      for library in libraries:
-        try:
-          results = enrichr_get_top_results(link['userListId'], library).sort_values('pvalue').iloc[:top_n_results]
-          results['link'] = link['link']
-          results['library'] = library
-          results['category'] = category
-          results['direction'] = link_type
-          results['cluster'] = cluster
-          all_results.append(results)
-        except:
-          print('{}: {} {} {} cluster {} failed, continuing'.format(link, library, category, link_type, cluster))
-
-df_all_results = pd.concat(all_results)
+    # lists without any result are recorded too, so they are not scored again
+    for cluster, link_type in library_lists:
+      computed[(cluster, link_type, category, library)] = None
+    for (cluster, link_type), list_results in results.groupby('list', sort=False):
+      list_results = list_results.drop(columns='list')
+      list_results['link'] = ''
+      computed[(cluster, link_type, category, library)] = list_results
+  return computed
 
-os.makedirs(output, exist_ok=True)
-df.to_csv(
-  os.path.join(output, 'df.tsv'),
-  sep='\t',
-  index=None
-)
-df_clustered_umap.to_csv(
-  os.path.join(output, 'df_umap.tsv'),
-  sep='\t',
-  index=None
+# ENRICHR_GMT points to a directory of <library>.gmt files to enrich offline
+gmt_path = os.environ.get('ENRICHR_GMT')
+library_sources = OrderedDict(
+  (library, file_stamp(os.path.join(gmt_path, library + '.gmt')) if gmt_path else enrichr.enrichr_link)
+  for libraries in useful_libs.values()
+  for library in libraries
 )
-df_all_results.to_csv(
-  os.path.join(output, 'df_enrich.tsv'),
-  sep='\t',
-  index=None
+
+def enrich_clusters():
+  ''' Top results of every (cluster, direction, library) by the fingerprint of what they were
+  computed from, so a rerun only queries the gene lists that changed and the libraries added
+  '''
+  gene_lists = OrderedDict()
+  for cluster, (up_genes, dn_genes) in top_genes_stage.value.items():
+    for link_type, genes in [('up', up_genes), ('down', dn_genes)]:
+      if genes.size:
+        gene_lists[(cluster, link_type)] = genes
+      else:
+        print('cluster %s %s: empty' % (cluster, link_type))
+  jobs = OrderedDict(
+    ((cluster, link_type, category, library), fingerprint(library, library_sources[library], top_n_results, genes))
+    for (cluster, link_type), genes in gene_lists.items()
+    for category, libraries in useful_libs.items()
+    for library in libraries
+  )
+  previous = (pipeline.previous('enrichment') or {}).get('results', {})
+  results = {key: previous[key] for key in jobs.values() if key in previous}
+  missing = [job for job, key in jobs.items() if key not in results]
+  if missing:
+    computed = (enrich_local if gmt_path else enrich_remote)(gene_lists, missing)
+    results.update((jobs[job], job_results) for job, job_results in computed.items())
+  return {'jobs': jobs, 'results': results}
+
+# failed requests and missing GMT files are retried on the next run
+enrichment_stage = pipeline.stage(
+  'enrichment',
+  [top_genes_stage, list(useful_libs.items()), library_sources, top_n_results],
+  enrich_clusters,
+  complete=lambda value: all(key in value['results'] for key in value['jobs'].values()),
 )
+
+def enrichment_table():
+  enrichment = enrichment_stage.value
+  all_results = []
+  for (cluster, link_type, category, library), key in enrichment['jobs'].items():
+    results = enrichment['results'].get(key)
+    if results is None:
+      continue
+    results = results.copy()
+    results['library'] = library
+    results['category'] = category
+    results['direction'] = link_type
+    results['cluster'] = cluster
+    all_results.append(results)
+  if all_results:
+    return pd.concat(all_results)
+  print('no enrichment results, writing an empty df_enrich.tsv')
+  return pd.DataFrame(columns=['rank', 'term', 'pvalue', 'zscore', 'combinedscore', 'overlapping_genes', 'adjusted_pvalue', '', '', 'link', 'library', 'category', 'direction', 'cluster'])
+
+def write_tsv(filename, inputs, table):
+  ''' Stage writing the DataFrame `table()` to `filename` in the output directory
+  '''
+  def write():
+    table().to_csv(
+      os.path.join(output, filename),
+      sep='\t',
+      index=None
+    )
+  return pipeline.stage(filename, inputs, write, outputs=[filename])
+
+os.makedirs(output, exist_ok=True)
+write_tsv('df.tsv', [expression_stage], lambda: expression_stage.value).run()
+write_tsv('df_umap.tsv', [umap_stage], lambda: umap_stage.value).run()
+write_tsv('df_enrich.tsv', [enrichment_stage], enrichment_table).run()
+
+# Optionally store the outputs as a memory-mappable columnar bundle for app.py
+if json.loads(os.environ.get('BUNDLE', 'false')):
+  from bundle import TABLES, write_bundle, stale_tables
+  pipeline.stage(
+    'bundle',
+    [file_stamp(os.path.join(output, spec['filename'])) for spec in TABLES.values()],
+    lambda: write_bundle(output, stale_tables(output)),
+    outputs=['bundle/manifest.json'],
+  ).run()
+
+print(pipeline.report())
+if os.environ.get('INIT_TIMINGS'):
+  with open(os.environ['INIT_TIMINGS'], 'w') as fw:
+    json.dump(pipeline.timings, fw, indent=2)
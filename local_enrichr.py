@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+columns = ['rank', 'term', 'pvalue', 'zscore', 'combinedscore', 'overlapping_genes', 'adjusted_pvalue', '', '']
+
+def read_gmt(path):
+  ''' Read an Enrichr style GMT file: term, description, then genes (optionally `GENE,weight`)
+  '''
+  gene_sets = OrderedDict()
+  with open(path, 'r') as fr:
+    for line in fr:
+      term, _description, *genes = line.rstrip('\r\n').split('\t')
+      gene_sets[term] = {gene.split(',')[0].strip().upper() for gene in genes if gene.strip()}
+  return gene_sets
+
+class GeneSetLibrary:
+  ''' A gene set library as a sparse gene x term incidence matrix.
+  The library's distinct genes form the background universe for the tests.
+  '''
+  def __init__(self, gene_sets):
+    import scipy.sparse as sp
+    self.gene_sets = gene_sets
+    self.terms = np.array(list(gene_sets), dtype=object)
+    self.genes = {
+      gene: i
+      for i, gene in enumerate(sorted(set.union(set(), *gene_sets.values())))
+    }
+    rows = np.fromiter((self.genes[gene] for genes in gene_sets.values() for gene in genes), dtype=np.int64)
+    cols = np.repeat(np.arange(len(self.terms)), [len(genes) for genes in gene_sets.values()])
+    self.matrix = sp.csr_matrix(
+      (np.ones(rows.shape[0], dtype=np.int32), (rows, cols)),
+      shape=(len(self.genes), len(self.terms)),
+    )
+    self.term_sizes = np.diff(self.matrix.tocsc().indptr)
+
+  @classmethod
+  def from_gmt(cls, path):
+    return cls(read_gmt(path))
+
+def enrich(library, gene_lists, top_n=None):
+  ''' Score every gene list against every term of `library` at once.
+  One sparse product gives the overlaps of all (list, term) pairs, then p-values
+  (one-sided Fisher / hypergeometric), Benjamini-Hochberg adjusted p-values, odds ratios
+  and combined scores (-ln(p) * odds ratio) are computed as arrays. Returns the
+  columns of the Enrichr `/enrich` API plus `list`, the key of the gene list in `gene_lists`.
+  '''
+  import scipy.sparse as sp
+  from scipy.stats import hypergeom
+  keys = list(gene_lists)
+  list_genes = [
+    {gene.upper() for gene in gene_lists[key] if isinstance(gene, str)}
+    for key in keys
+  ]
+  query = [
+    sorted(library.genes[gene] for gene in genes if gene in library.genes)
+    for genes in list_genes
+  ]
+  Q = sp.csr_matrix(
+    (
+      np.ones(sum(map(len, query)), dtype=np.int32),
+      np.fromiter((gene for genes in query for gene in genes), dtype=np.int64),
+      np.cumsum([0] + [len(genes) for genes in query]),
+    ),
+    shape=(len(keys), len(library.genes)),
+  )
+  overlap = (Q @ library.matrix).tocoo()
+  i, j, k = overlap.row, overlap.col, overlap.data.astype(np.float64)
+  N = len(library.genes)
+  n = np.diff(Q.indptr)[i].astype(np.float64)
+  K = library.term_sizes[j].astype(np.float64)
+  pvalue = hypergeom.sf(k - 1, N, K, n)
+  # 2x2 table: a in list & term, b in list only, c in term only, d neither
+  a, b, c, d = k, n - k, K - k, N - n - K + k
+  oddsratio = (a * d) / np.maximum(b * c, 1)
+  combinedscore = -np.log(np.maximum(pvalue, np.finfo(np.float64).tiny)) * oddsratio
+  df = pd.DataFrame({
+    'list': i,
+    'term_index': j,
+    'pvalue': pvalue,
+    'zscore': oddsratio,
+    'combinedscore': combinedscore,
+  }).sort_values(['list', 'pvalue'], kind='mergesort', ignore_index=True)
+  grouped = df.groupby('list', sort=False)
+  df['rank'] = grouped.cumcount() + 1
+  bh = df['pvalue'] * grouped['pvalue'].transform('size') / df['rank']
+  df['adjusted_pvalue'] = bh[::-1].groupby(df['list'][::-1]).cummin()[::-1].clip(upper=1)
+  if top_n is not None:
+    df = df[df['rank'] <= top_n].copy()
+  df['term'] = library.terms[df['term_index'].values]
+  df['overlapping_genes'] = [
+    sorted(list_genes[list_index] & library.gene_sets[term])
+    for list_index, term in zip(df['list'], df['term'])
+  ]
+  df['list'] = [keys[list_index] for list_index in df['list']]
+  results = pd.concat([
+    df[['list'] + columns[:-2]],
+    pd.DataFrame(0, index=df.index, columns=['', '']),
+  ], axis=1)
+  return results.reset_index(drop=True)
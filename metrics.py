@@ -0,0 +1,84 @@
+''' In-process metrics for app.py in the Prometheus text exposition format.
+
+Only histograms and gauges are needed, so this avoids a client library dependency.
+Values are per process: with several workers every worker reports its own.
+'''
+import bisect
+import threading
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+def format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    ) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None:
+                # per bucket counts, then +Inf, then sum
+                counts = self.series[key] = [0] * (len(self.buckets) + 1) + [0.]
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self.lock:
+            series = {key: list(counts) for key, counts in self.series.items()}
+        for key, counts in sorted(series.items()):
+            cumulative = 0
+            for le, count in zip([*map(format_value, self.buckets), '+Inf'], counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, format_labels(key, [('le', le)]), cumulative)
+            yield '{}_sum{} {}'.format(self.name, format_labels(key), format_value(counts[-1]))
+            yield '{}_count{} {}'.format(self.name, format_labels(key), cumulative)
+
+class Gauge:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def set(self, value, **labels):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} gauge'.format(self.name)
+        for key, value in sorted(self.series.items()):
+            yield '{}{} {}'.format(self.name, format_labels(key), format_value(value))
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, *args, **kwargs):
+        self.metrics.append(Histogram(*args, **kwargs))
+        return self.metrics[-1]
+
+    def gauge(self, *args, **kwargs):
+        self.metrics.append(Gauge(*args, **kwargs))
+        return self.metrics[-1]
+
+    def render(self):
+        return ''.join(line + '\n' for metric in self.metrics for line in metric.render())
@@ -0,0 +1,75 @@
+''' Responses serialized once and served compressed with HTTP validators.
+
+A `Payload` holds the JSON bytes of a response that only changes when its cohort is
+reloaded, with gzip (and brotli, when installed) variants compressed on first use.
+`respond` picks the variant the client accepts and answers revalidations with 304.
+'''
+import gzip
+import hashlib
+import threading
+import flask
+
+# bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+def dumps(value):
+    ''' JSON bytes of `value` as Dash serializes it, with orjson when it is installed
+    '''
+    from plotly.io.json import to_json_plotly
+    return to_json_plotly(value).encode()
+
+def compress(body, encoding):
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+def encodings():
+    ''' Content encodings this server can produce, preferred first
+    '''
+    try:
+        import brotli
+        return ['br', 'gzip']
+    except ImportError:
+        return ['gzip']
+
+class Payload:
+    def __init__(self, body, mimetype='application/json'):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.encoded = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def json(cls, value):
+        return cls(dumps(value))
+
+    def encode(self, encoding):
+        with self.lock:
+            if encoding not in self.encoded:
+                self.encoded[encoding] = compress(self.body, encoding)
+            return self.encoded[encoding]
+
+def respond(payload, cache_control='private, no-cache'):
+    ''' Serve `payload` for the current request: 304 if the client's copy is current, else
+    the body in the best encoding the client accepts. `no-cache` makes browsers revalidate
+    on every use, which costs a 304 rather than the body while the cohort is unchanged.
+    '''
+    request = flask.request
+    if request.if_none_match.contains_weak(payload.etag):
+        response = flask.Response(status=304)
+    else:
+        encoding = None
+        if len(payload.body) >= MIN_COMPRESS_BYTES:
+            encoding = next((e for e in encodings() if request.accept_encodings[e]), None)
+        response = flask.Response(
+            payload.encode(encoding) if encoding else payload.body,
+            mimetype=payload.mimetype,
+        )
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(payload.etag, weak=True)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
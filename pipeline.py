@@ -0,0 +1,176 @@
+''' Stage cache for init.py.
+
+Every stage is fingerprinted by its parameters and by the fingerprints of what it reads,
+input files or other stages. Its result is pickled under `<output>/.pipeline/` and
+`manifest.json` records the fingerprint each artifact was built from, so a rerun only
+rebuilds the stages whose inputs changed. Stage values are loaded lazily: a stage that is
+up to date and not needed by a stale one is not read at all.
+'''
+import os
+import json
+import time
+import pickle
+import hashlib
+from collections import OrderedDict
+
+PIPELINE_VERSION = 1
+
+def encode(value):
+  if isinstance(value, Stage):
+    return value.fingerprint
+  if hasattr(value, 'tolist'):
+    return value.tolist()
+  raise TypeError('cannot fingerprint {!r}'.format(type(value)))
+
+def fingerprint(*values):
+  ''' Stable digest of JSON-able values (numpy arrays and stages included)
+  '''
+  return hashlib.sha256(json.dumps(values, sort_keys=True, default=encode).encode()).hexdigest()
+
+def file_stamp(path):
+  ''' Cheap fingerprint of an input or output file, None if it does not exist
+  '''
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return {'size': st.st_size, 'mtime': st.st_mtime}
+
+class Stage:
+  def __init__(self, pipeline, name, fingerprint, build, outputs=(), complete=None):
+    self.pipeline = pipeline
+    self.name = name
+    self.fingerprint = fingerprint
+    self.build = build
+    self.outputs = outputs
+    self.complete = complete
+    self.fresh = pipeline.fresh(self)
+    self.loaded = False
+
+  @property
+  def value(self):
+    ''' The stage's result, read from its artifact when fresh, otherwise built and stored
+    '''
+    if not self.loaded:
+      if self.fresh and self.outputs:
+        self._value = None
+      elif self.fresh:
+        self._value = self.pipeline.timed(self.name, 'cached', lambda: self.pipeline.load(self.name))
+      else:
+        self._value = self.pipeline.timed(self.name, 'built', self.build)
+        self.pipeline.save(self, self._value)
+        self.fresh = True
+      self.loaded = True
+    return self._value
+
+  def run(self):
+    ''' Bring the stage up to date
+    '''
+    return self.value
+
+class Pipeline:
+  ''' Manifest and artifacts of the stages run against one output directory
+  '''
+  def __init__(self, output):
+    self.output = output
+    self.directory = os.path.join(output, '.pipeline')
+    self.manifest = self.read_manifest()
+    self.timings = OrderedDict()
+    self.status = OrderedDict()
+    self.nested = 0.
+
+  def read_manifest(self):
+    try:
+      with open(os.path.join(self.directory, 'manifest.json'), 'r') as fr:
+        manifest = json.load(fr)
+    except FileNotFoundError:
+      manifest = None
+    if manifest is None or manifest.get('version') != PIPELINE_VERSION:
+      manifest = {'version': PIPELINE_VERSION, 'stages': {}}
+    return manifest
+
+  def write_manifest(self):
+    os.makedirs(self.directory, exist_ok=True)
+    tmp = os.path.join(self.directory, 'manifest.json.tmp')
+    with open(tmp, 'w') as fw:
+      json.dump(self.manifest, fw, indent=2)
+    os.replace(tmp, os.path.join(self.directory, 'manifest.json'))
+
+  def artifact(self, name):
+    return os.path.join(self.directory, name + '.pkl')
+
+  def stage(self, name, inputs, build, outputs=(), complete=None):
+    ''' Declare stage `name`, built by `build()` from `inputs`: file stamps, parameters and the
+    upstream stages it reads, which are stale when any of them is. A stage with `outputs` writes
+    those files (relative to the output directory) and is also stale when they were
+    changed or removed since; its value is not stored. A value for which `complete(value)`
+    is false is stored for `previous` but the stage is built again on the next run.
+    '''
+    stage = Stage(self, name, fingerprint(name, inputs), build, outputs, complete)
+    stage.fresh = stage.fresh and all(upstream.fresh for upstream in inputs if isinstance(upstream, Stage))
+    if stage.fresh:
+      self.timings[name] = 0.
+      self.status[name] = 'cached'
+    return stage
+
+  def fresh(self, stage):
+    entry = self.manifest['stages'].get(stage.name)
+    if entry is None or entry['fingerprint'] != stage.fingerprint:
+      return False
+    if stage.outputs:
+      return all(
+        file_stamp(os.path.join(self.output, path)) == entry['outputs'].get(path)
+        for path in stage.outputs
+      )
+    return os.path.exists(self.artifact(stage.name))
+
+  def load(self, name):
+    with open(self.artifact(name), 'rb') as fr:
+      return pickle.load(fr)
+
+  def previous(self, name):
+    ''' The last stored value of stage `name` whatever its inputs were, None if there is none
+    '''
+    try:
+      return self.load(name)
+    except FileNotFoundError:
+      return None
+
+  def save(self, stage, value):
+    ''' Store the artifact, then record it in the manifest, so an interrupted run keeps
+    every completed stage
+    '''
+    os.makedirs(self.directory, exist_ok=True)
+    complete = stage.complete is None or stage.complete(value)
+    entry = {'fingerprint': stage.fingerprint if complete else None}
+    if stage.outputs:
+      entry['outputs'] = {
+        path: file_stamp(os.path.join(self.output, path))
+        for path in stage.outputs
+      }
+    else:
+      path = self.artifact(stage.name)
+      with open(path + '.tmp', 'wb') as fw:
+        pickle.dump(value, fw, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(path + '.tmp', path)
+    self.manifest['stages'][stage.name] = entry
+    self.write_manifest()
+
+  def timed(self, name, status, func):
+    ''' Run `func` as stage `name`, excluding the time of the upstream stages it evaluates
+    '''
+    outer, self.nested = self.nested, 0.
+    start = time.perf_counter()
+    try:
+      return func()
+    finally:
+      elapsed = time.perf_counter() - start
+      self.timings[name] = self.timings.get(name, 0.) + elapsed - self.nested
+      self.status[name] = status
+      self.nested = outer + elapsed
+
+  def report(self):
+    lines = ['{:<16} {:<8} {:>10}'.format('stage', 'status', 'seconds')]
+    for name, seconds in self.timings.items():
+      lines.append('{:<16} {:<8} {:>10.3f}'.format(name, self.status[name], seconds))
+    return '\n'.join(lines)
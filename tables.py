@@ -0,0 +1,81 @@
+''' Server-side filtering, sorting and paging of app.py's DataTables (`*_action='custom'`).
+'''
+import re
+import operator
+import numpy as np
+import pandas as pd
+
+filter_operators = {
+    '=': operator.eq, 'eq': operator.eq,
+    '!=': operator.ne, 'ne': operator.ne,
+    '<': operator.lt, 'lt': operator.lt,
+    '<=': operator.le, 'le': operator.le,
+    '>': operator.gt, 'gt': operator.gt,
+    '>=': operator.ge, 'ge': operator.ge,
+}
+filter_term = re.compile(r'^\{(?P<column>[^}]+)\}\s*(?P<operator>[si]?(?:contains|datestartswith|eq|ne|lt|le|gt|ge|<=|>=|!=|=|<|>))\s*(?P<value>.*)$')
+
+def parse_filter_query(filter_query):
+    ''' DataTable `filter_query` -> [(column, operator, value)], terms joined with `&&`
+    '''
+    terms = []
+    for part in (filter_query or '').split(' && '):
+        match = filter_term.match(part.strip())
+        if match is None:
+            continue
+        value = match.group('value').strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        else:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        terms.append((match.group('column'), match.group('operator').lstrip('si'), value))
+    return terms
+
+def sort_table(df, sort_by):
+    ''' `df` sorted by the DataTable `sort_by`, stable. Columns mixing types (like the
+    patient panel's values) sort numbers first, then text, then missing values (the other way
+    around when descending).
+    '''
+    keys, ascending = {}, []
+    for s in sort_by:
+        values = df[s['column_id']].reset_index(drop=True)
+        asc = s['direction'] == 'asc'
+        if values.dtype == object:
+            numeric = pd.to_numeric(values, errors='coerce')
+            keys[len(keys)] = np.where(values.isna(), 2, np.where(numeric.notna(), 0, 1))
+            keys[len(keys)] = numeric
+            keys[len(keys)] = values.astype(str)
+            ascending += [asc] * 3
+        else:
+            keys[len(keys)] = values
+            ascending.append(asc)
+    order = pd.DataFrame(keys).sort_values(list(keys), ascending=ascending, kind='mergesort').index
+    return df.iloc[order]
+
+def query_table(df, filter_query=None, sort_by=None, page_current=0, page_size=25, presorted=None):
+    ''' Answer a DataTable custom filter/sort/page request from a pre-sorted frame.
+    Returns the records of the requested page and the page count. Sorting is skipped
+    when `sort_by` matches the order the frame was sorted in at startup.
+    '''
+    mask = np.ones(df.shape[0], dtype=bool)
+    for column, op, value in parse_filter_query(filter_query):
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if op in ('contains', 'datestartswith'):
+            values = values.astype(str)
+            mask &= (values.str.contains(str(value), case=False, regex=False) if op == 'contains' else values.str.startswith(str(value))).values
+        elif isinstance(value, float):
+            mask &= filter_operators[op](pd.to_numeric(values, errors='coerce'), value).values
+        else:
+            mask &= filter_operators[op](values.astype(str), value).values
+    if not mask.all():
+        df = df[mask]
+    if sort_by and sort_by != presorted:
+        df = sort_table(df, sort_by)
+    page_current, page_size = page_current or 0, page_size or 25
+    page_count = max(1, -(-df.shape[0] // page_size))
+    return df.iloc[page_current * page_size:(page_current + 1) * page_size].to_dict('records'), page_count
@@ -0,0 +1,19 @@
+import pandas as pd
+from cohort import MetadataIndex
+
+def metadata_index():
+    return MetadataIndex(pd.DataFrame(
+        {'type_subject': ['lung', 'liver', 'lung 57'], 'age': [57, 40, 61], 'Labels': [1.0, 0.0, 1.0]},
+        index=pd.Index(['a', 'b', 'c'], name='Barcode'),
+    ))
+
+def test_search_numeric_value():
+    index = metadata_index()
+    assert index.barcodes[index.search('age:57')].tolist() == ['a']
+    assert index.barcodes[index.search('Labels:1')].tolist() == ['a', 'c']
+    assert index.barcodes[index.search('age:50..')].tolist() == ['a', 'c']
+
+def test_search_bare_number():
+    index = metadata_index()
+    assert index.barcodes[index.search('57')].tolist() == ['a', 'c']
+    assert index.barcodes[index.search('lung 40')].tolist() == []
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+from cohort import MetadataStore
+from tables import query_table
+
+def metadata_table():
+    df_metadata = pd.DataFrame(
+        {'type_subject': ['lung'], 'age': [57], 'weight': [np.nan], 'smoker': ['no']},
+        index=pd.Index(['AAACCTGAGAAGGCCT-1'], name='Barcode'),
+    )
+    store = MetadataStore(df_metadata)
+    return pd.DataFrame(store.records(0, 'AAACCTGAGAAGGCCT-1', 3))
+
+def test_sort_metadata_ascending():
+    records, page_count = query_table(metadata_table(), sort_by=[{'column_id': 'value', 'direction': 'asc'}])
+    assert page_count == 1
+    assert [r['attribute'] for r in records] == ['Cluster', 'age', 'Barcode', 'type_subject', 'smoker', 'weight']
+
+def test_sort_metadata_descending():
+    records, _ = query_table(metadata_table(), sort_by=[{'column_id': 'value', 'direction': 'desc'}])
+    assert [r['attribute'] for r in records] == ['weight', 'smoker', 'type_subject', 'Barcode', 'age', 'Cluster']